@@ -0,0 +1,441 @@
+from oauth2client.service_account import ServiceAccountCredentials
+from datetime import date as Date, datetime
+from gspread.urls import SPREADSHEETS_API_V4_BASE_URL
+from gspread.utils import rowcol_to_a1
+from scheduler import SheetScheduler
+import gspread
+import sqlite3
+import threading
+
+
+# Sheet layout, 1-indexed columns (A to H)
+DATE, DAYS = 4, 7
+WIDTH = 8
+
+# gspread 3 has no wrapper for reading or writing several ranges at once
+SPREADSHEET_VALUES_BATCH_URL = SPREADSHEETS_API_V4_BASE_URL + '/%s/values:batchGet'
+SPREADSHEET_VALUES_BATCH_UPDATE_URL = SPREADSHEETS_API_V4_BASE_URL + '/%s/values:batchUpdate'
+
+
+class SheetBackend:
+    """Storage interface DocScanner reads the roster from and writes to
+
+    Rows and columns are 1-indexed and follow the leaderboard layout:
+    A name, B splits, C items, D date, E rank, G days, H manual rank.
+    Values come back as strings, the way the sheet displays them
+
+    Methods:
+    --------
+    connect():
+        (Re)opens the underlying storage
+
+    get_all_values():
+        Every row as a list of strings
+
+    col_values(col: int):
+        One column down to its last non-empty cell
+
+    get_columns(cols: tuple):
+        Several columns, each as col_values would return it, in one read
+
+    get_rows(rows: iterable):
+        {row: [values]} for just those rows, in one read
+
+    cell(row: int, col: int):
+        The value of a single cell
+
+    update_cell(row: int, col: int, value):
+        Writes a single cell
+
+    update_cells(cells: dict, echo: bool):
+        Writes {(row, col): value} as one batch. A value of None leaves the
+        cell as it is. With echo, returns {row: [values]} for the rows written
+
+    stats():
+        Backend specific load figures, if any
+    """
+
+    def connect(self):
+        pass
+
+    def get_all_values(self):
+        raise NotImplementedError
+
+    def col_values(self, col):
+        values = [row[col - 1] if len(row) >= col else '' for row in self.get_all_values()]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get_columns(self, cols):
+        rows = self.get_all_values()
+        columns = []
+        for col in cols:
+            values = [row[col - 1] if len(row) >= col else '' for row in rows]
+            while values and not values[-1]:
+                values.pop()
+            columns.append(values)
+        return columns
+
+    def get_rows(self, rows):
+        values = self.get_all_values()
+        return {row: list(values[row - 1]) if row <= len(values) else [] for row in rows}
+
+    def cell(self, row, col):
+        rows = self.get_all_values()
+        if row > len(rows) or col > len(rows[row - 1]):
+            return ''
+        return rows[row - 1][col - 1]
+
+    def update_cell(self, row, col, value):
+        self.update_cells({(row, col): value})
+
+    def update_cells(self, cells, echo=False):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class GoogleClient:
+    """Credentials, gspread client and scheduler shared between sheets
+
+    Every sheet opened through the same GoogleClient uses one authorized
+    HTTP session (and its connection pool) and one request quota
+
+    Parameters:
+    creds_file: str - Service account key file
+    scheduler: SheetScheduler - Rate limits and retries every sheet call
+
+    Methods:
+    --------
+    authorize(stale: gspread.Client):
+        Returns the shared gspread client. Passing the client a sheet was
+        using when its connection failed makes a new one, once
+    """
+
+    scope = [
+        'https://spreadsheets.google.com/feeds',
+        'https://www.googleapis.com/auth/drive'
+    ]
+
+    def __init__(self, creds_file='credentials.json', scheduler=None):
+        self.scheduler = scheduler or SheetScheduler()
+        self.creds = ServiceAccountCredentials.from_json_keyfile_name(
+            creds_file,
+            self.scope
+        )
+        self.gc = None
+        self.lock = threading.Lock()
+
+    def authorize(self, stale=None):
+        with self.lock:
+            # Another sheet may have re-authorized already
+            if self.gc is None or self.gc is stale:
+                self.gc = gspread.authorize(self.creds)
+            return self.gc
+
+
+class GoogleSheetBackend(SheetBackend):
+    """The clan's Google sheet, accessed through gspread
+
+    Parameters:
+    ss_URL: str - URL of the google sheet to access
+    ws_name: str - Name of the worksheet (or tab) on the google sheet
+    scheduler: SheetScheduler - Rate limits and retries every sheet call
+    creds_file: str - Service account key file
+    client: GoogleClient - Shared credentials and scheduler, replaces
+        scheduler and creds_file if given
+    """
+
+    def __init__(self, ss_URL, ws_name, scheduler=None, creds_file='credentials.json',
+                 client=None):
+        self.ss_URL = ss_URL
+        self.ws_name = ws_name
+        self.client = client or GoogleClient(creds_file, scheduler)
+        self.scheduler = self.client.scheduler
+        self.gc = None
+        self.sheet = None
+
+    def connect(self):
+        """Opens the document and assigns worksheet to instance variable"""
+        # A reconnect re-authorizes, the first connect reuses the shared client
+        self.gc = self.client.authorize(stale=self.gc)
+        spreadsheet = self.scheduler.call(self.gc.open_by_url, self.ss_URL)
+        self.sheet = self.scheduler.call(spreadsheet.worksheet, self.ws_name)
+
+    def get_all_values(self):
+        return self.scheduler.call(self.sheet.get_all_values)
+
+    def col_values(self, col):
+        return self.scheduler.call(self.sheet.col_values, col)
+
+    def get_columns(self, cols):
+        """Reads only the given columns with one values:batchGet call"""
+        # Neighbouring columns share a range, e.g. A:C, E:E, G:H
+        spans = []
+        for col in sorted(cols):
+            if spans and spans[-1][1] == col - 1:
+                spans[-1][1] = col
+            else:
+                spans.append([col, col])
+
+        title = self.sheet.title.replace("'", "''")
+        ranges = [
+            "'%s'!%s:%s" % (title, _col_letter(left), _col_letter(right)) 
+            for left, right in spans
+        ]
+        response = self.scheduler.call(
+            self.sheet.spreadsheet.client.request,
+            'get',
+            SPREADSHEET_VALUES_BATCH_URL % self.sheet.spreadsheet.id,
+            params={'ranges': ranges, 'majorDimension': 'COLUMNS'}
+        )
+        value_ranges = response.json().get('valueRanges', [])
+
+        found = {}
+        for (left, right), value_range in zip(spans, value_ranges):
+            values = value_range.get('values', [])
+            for col in range(left, right + 1):
+                i = col - left
+                found[col] = values[i] if i < len(values) else []
+        return [found.get(col, []) for col in cols]
+
+    def get_rows(self, rows):
+        """Reads just the given rows with one values:batchGet call"""
+        rows = sorted(set(rows))
+        title = self.sheet.title.replace("'", "''")
+        last = _col_letter(WIDTH)
+        ranges = ["'%s'!A%d:%s%d" % (title, row, last, row) for row in rows]
+        response = self.scheduler.call(
+            self.sheet.spreadsheet.client.request,
+            'get',
+            SPREADSHEET_VALUES_BATCH_URL % self.sheet.spreadsheet.id,
+            params={'ranges': ranges, 'majorDimension': 'ROWS'}
+        )
+        value_ranges = response.json().get('valueRanges', [])
+
+        found = {}
+        for row, value_range in zip(rows, value_ranges):
+            values = value_range.get('values', [])
+            found[row] = values[0] if values else []
+        return {row: found.get(row, []) for row in rows}
+
+    def cell(self, row, col):
+        return self.scheduler.call(self.sheet.cell, row, col).value
+
+    def update_cells(self, cells, echo=False):
+        """Writes the cells with one values:batchUpdate call, one range
+        per run of rows sharing the same columns
+        """
+        # Each row spans its first to last column, None tells the API to
+        # skip a cell in between. Rows far apart don't pad out the request
+        spans = {}
+        for row, col in cells:
+            left, right = spans.get(row, (col, col))
+            spans[row] = (min(left, col), max(right, col))
+
+        # Neighbouring rows over the same columns share a range
+        runs = []
+        for row in sorted(spans):
+            if runs and runs[-1][1] == row - 1 and runs[-1][2] == spans[row]:
+                runs[-1][1] = row
+            else:
+                runs.append([row, row, spans[row]])
+
+        title = self.sheet.title.replace("'", "''")
+        data = []
+        for top, bottom, (left, right) in runs:
+            values = [
+                [cells.get((row, col)) for col in range(left, right + 1)]
+                for row in range(top, bottom + 1)
+            ]
+            data.append({
+                'range': "'%s'!%s:%s" % (
+                    title, rowcol_to_a1(top, left), rowcol_to_a1(bottom, right)
+                ),
+                'values': values
+            })
+
+        body = {'valueInputOption': 'USER_ENTERED', 'data': data}
+        if echo:
+            body['includeValuesInResponse'] = True
+        response = self.scheduler.call(
+            self.sheet.spreadsheet.client.request,
+            'post',
+            SPREADSHEET_VALUES_BATCH_UPDATE_URL % self.sheet.spreadsheet.id,
+            json=body,
+            write=True
+        )
+        if not echo:
+            return None
+
+        # Pads the echoed values back out to full sheet rows
+        responses = response.json().get('responses', [])
+        updated = {}
+        for i, (top, bottom, (left, right)) in enumerate(runs):
+            data = responses[i] if i < len(responses) else {}
+            echoed = data.get('updatedData', {}).get('values', [])
+            for j in range(bottom - top + 1):
+                values = echoed[j] if j < len(echoed) else []
+                updated[top + j] = [''] * (left - 1) + values
+        return updated
+
+    def stats(self):
+        return self.scheduler.stats()
+
+
+class MemoryBackend(SheetBackend):
+    """A sheet held in a list of rows, for offline runs and load tests
+
+    Parameters:
+    rows: list - Starting rows, each a list of cell values
+    """
+
+    def __init__(self, rows=()):
+        self.lock = threading.Lock()
+        self.rows = []
+        self.load_rows(rows)
+
+    def load_rows(self, rows):
+        """Replaces the contents with rows"""
+        with self.lock:
+            self.rows = [self._pad([str(value) for value in row]) for row in rows]
+
+    @staticmethod
+    def _pad(row):
+        return row + [''] * (WIDTH - len(row))
+
+    def get_all_values(self):
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+    def get_rows(self, rows):
+        with self.lock:
+            return {
+                row: list(self.rows[row - 1]) if row <= len(self.rows) else [] 
+                for row in rows
+            }
+
+    def update_cells(self, cells, echo=False):
+        with self.lock:
+            for (row, col), value in cells.items():
+                if value is None:
+                    continue
+                while len(self.rows) < row:
+                    self.rows.append([''] * WIDTH)
+                line = self.rows[row - 1]
+                if len(line) < col:
+                    line.extend([''] * (col - len(line)))
+                line[col - 1] = str(value)
+            if echo:
+                return {row: list(self.rows[row - 1]) for row, _ in cells}
+
+
+class SQLiteBackend(SheetBackend):
+    """A local SQLite file laid out like the sheet, one table row per sheet row
+
+    Days in clan (column G) is worked out from the join date on read, the
+    same as the sheet formula does
+
+    Parameters:
+    path: str - SQLite database file
+    """
+
+    columns = ('name', 'splits', 'items', 'date', 'rank', 'f', 'days', 'manual_rank')
+
+    def __init__(self, path='roster.db'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        self.connect()
+
+    def connect(self):
+        if self.db is not None:
+            self.db.close()
+        # Calls come from the sheet thread pool, the lock serialises them
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            cols = ', '.join(f'{col} TEXT NOT NULL DEFAULT \'\'' for col in self.columns)
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS roster (row INTEGER PRIMARY KEY, {cols})')
+            self.db.execute('CREATE INDEX IF NOT EXISTS roster_name ON roster (name)')
+
+    def load_rows(self, rows):
+        """Replaces the contents with rows"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM roster')
+            self.db.executemany(
+                'INSERT INTO roster VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    [i + 1] + [str(v) for v in (list(row) + [''] * WIDTH)[:WIDTH]]
+                    for i, row in enumerate(rows)
+                ]
+            )
+
+    @staticmethod
+    def _days(row):
+        # Fills in days since the join date, like the sheet's formula
+        try:
+            joined = datetime.strptime(row[DATE - 1], '%m/%d/%Y').date()
+        except ValueError:
+            return row
+        row[DAYS - 1] = str((Date.today() - joined).days)
+        return row
+
+    def _rows(self, query, params=()):
+        rows = {}
+        for record in self.db.execute(query, params):
+            rows[record[0]] = self._days(list(record[1:]))
+        return rows
+
+    def get_all_values(self):
+        with self.lock:
+            rows = self._rows('SELECT * FROM roster ORDER BY row')
+        # Keeps sheet row numbers lined up with list positions
+        last = max(rows) if rows else 0
+        return [rows.get(i, [''] * WIDTH) for i in range(1, last + 1)]
+
+    def col_values(self, col):
+        with self.lock:
+            records = self.db.execute(
+                f'SELECT row, {self.columns[col - 1]} FROM roster ORDER BY row'
+            ).fetchall()
+        values = {}
+        for row, value in records:
+            values[row] = value
+        column = [values.get(i, '') for i in range(1, max(values, default=0) + 1)]
+        while column and not column[-1]:
+            column.pop()
+        return column
+
+    def get_rows(self, rows):
+        rows = sorted(set(rows))
+        marks = ', '.join('?' * len(rows))
+        with self.lock:
+            found = self._rows(f'SELECT * FROM roster WHERE row IN ({marks})', rows)
+        return {row: found.get(row, []) for row in rows}
+
+    def cell(self, row, col):
+        with self.lock:
+            rows = self._rows('SELECT * FROM roster WHERE row = ?', (row,))
+        return rows[row][col - 1] if row in rows else ''
+
+    def update_cells(self, cells, echo=False):
+        with self.lock, self.db:
+            for (row, col), value in cells.items():
+                if value is None:
+                    continue
+                self.db.execute('INSERT OR IGNORE INTO roster (row) VALUES (?)', (row,))
+                self.db.execute(
+                    f'UPDATE roster SET {self.columns[col - 1]} = ? WHERE row = ?',
+                    (str(value), row)
+                )
+            if echo:
+                written = sorted({row for row, _ in cells})
+                marks = ', '.join('?' * len(written))
+                return self._rows(f'SELECT * FROM roster WHERE row IN ({marks})', written)
+
+
+def _col_letter(col):
+    # rowcol_to_a1(1, 3) is "C1", the column is everything before the row
+    return rowcol_to_a1(1, col)[:-1]
@@ -0,0 +1,535 @@
+"""Offline load test for the command pipeline
+
+Runs synthetic traces of .check, .update, .add and .remove through
+RedemptionBot.check, the same path a discord message takes, against fake
+discord objects. Sheet calls go through the real GoogleSheetBackend to an
+in-memory stand-in for the gspread worksheet with configurable latency
+and quota errors. Nothing is sent to discord or Google
+
+    python bench.py --rows 100 1000 10000 50000 --commands 500
+
+Reports throughput, p50/p99 latency and sheet calls per command for each
+roster size
+"""
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+
+from backends import GoogleSheetBackend, MemoryBackend
+from change_log import ChangeLog
+from doc_scan import DocScanner, AsyncDocScanner, DocDirectory
+from main import RedemptionBot, router
+from scheduler import SheetScheduler
+from write_behind import WriteBehind
+
+
+# Sheet calls made on behalf of the command being run, as a one item list
+# so worker threads (which get a copy of the context) can add to it
+_sheet_calls = contextvars.ContextVar('sheet_calls', default=None)
+
+KINDS = ('check', 'update', 'add', 'remove')
+
+
+class QuotaResponse:
+    """Enough of a requests response for gspread's APIError"""
+
+    status_code = 429
+    text = 'Quota exceeded (simulated)'
+
+    def json(self):
+        return {'error': {'code': 429, 'message': self.text, 'status': 'RESOURCE_EXHAUSTED'}}
+
+
+class FakeResponse:
+    """requests response carrying a JSON payload"""
+
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSheetsAPI:
+    """The Google Sheets API as seen through gspread, held in memory
+
+    Stands in below GoogleSheetBackend, so its request shaping (batchGet
+    and batchUpdate ranges, echo padding) runs as it does against Google.
+    Every call takes latency seconds (plus per_row seconds for each row
+    read) and fails with a 429 quota error error_rate of the time. Like
+    the real API, responses leave out trailing empty cells
+
+    Parameters:
+    rows: list - Starting rows, each a list of cell values
+    latency: float - Seconds each call takes
+    per_row: float - Extra seconds per row for calls that read the sheet
+    error_rate: float - Fraction of calls that fail with a quota error
+    seed: int - Seeds the quota errors
+    """
+
+    def __init__(self, rows, latency=0.1, per_row=0.0, error_rate=0.0, seed=None):
+        self.sheet = MemoryBackend(rows)
+        self.latency = latency
+        self.per_row = per_row
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self, func, *args, read=True, **kwargs):
+        with self.lock:
+            self.calls += 1
+        counter = _sheet_calls.get()
+        if counter is not None:
+            counter[0] += 1
+        delay = self.latency
+        if read:
+            delay += self.per_row * len(self.sheet.rows)
+        time.sleep(delay)
+        if self.random.random() < self.error_rate:
+            raise gspread.exceptions.APIError(QuotaResponse())
+        return func(*args, **kwargs)
+
+    @staticmethod
+    def _trim(values):
+        values = list(values)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    @staticmethod
+    def _parse_range(label):
+        """(top, left, bottom, right) from e.g. 'Sheet'!A2:H2 or 'Sheet'!A:C,
+        top and bottom are None for whole columns
+        """
+        corners = label.rsplit('!', 1)[-1].split(':')
+        bounds = []
+        for corner in corners:
+            letters = corner.rstrip('0123456789')
+            digits = corner[len(letters):]
+            col = 0
+            for letter in letters:
+                col = col * 26 + ord(letter.upper()) - ord('A') + 1
+            bounds.append((int(digits) if digits else None, col))
+        (top, left), (bottom, right) = bounds[0], bounds[-1]
+        return top, left, bottom, right
+
+    def _read(self, label, major):
+        top, left, bottom, right = self._parse_range(label)
+        rows = self.sheet.get_all_values()
+        top = top or 1
+        bottom = bottom or len(rows)
+        block = [row[left - 1:right] for row in rows[top - 1:bottom]]
+        if major == 'COLUMNS':
+            block = [list(column) for column in zip(*block)] if block else []
+        return [self._trim(line) for line in self._trim(block)]
+
+    def batch_get(self, params):
+        major = params.get('majorDimension', 'ROWS')
+        return FakeResponse({'valueRanges': [
+            {'range': label, 'values': self._read(label, major)} for label in params['ranges']
+        ]})
+
+    def batch_update(self, body):
+        cells = {}
+        for data in body['data']:
+            top, left, _, _ = self._parse_range(data['range'])
+            for i, line in enumerate(data['values']):
+                for j, value in enumerate(line):
+                    # None leaves the cell as it is
+                    if value is not None:
+                        cells[(top + i, left + j)] = value
+        self.sheet.update_cells(cells)
+        responses = []
+        for data in body['data']:
+            response = {'updatedRange': data['range']}
+            if body.get('includeValuesInResponse'):
+                response['updatedData'] = {'values': self._read(data['range'], 'ROWS')}
+            responses.append(response)
+        return FakeResponse({'responses': responses})
+
+
+class FakeWorksheet:
+    def __init__(self, api, spreadsheet, title):
+        self.api = api
+        self.spreadsheet = spreadsheet
+        self.title = title
+
+    def get_all_values(self):
+        return self.api.call(self.api.sheet.get_all_values)
+
+    def col_values(self, col):
+        return self.api.call(self.api.sheet.col_values, col)
+
+    def cell(self, row, col):
+        return self.api.call(lambda: FakeCell(self.api.sheet.cell(row, col)))
+
+
+class FakeSpreadsheet:
+    id = 'bench'
+
+    def __init__(self, api, client):
+        self.api = api
+        self.client = client
+
+    def worksheet(self, title):
+        return self.api.call(FakeWorksheet, self.api, self, title)
+
+
+class FakeGspreadClient:
+    """gspread.Client: opens the spreadsheet and sends raw requests"""
+
+    def __init__(self, api):
+        self.api = api
+
+    def open_by_url(self, url):
+        return self.api.call(FakeSpreadsheet, self.api, self)
+
+    def request(self, method, endpoint, params=None, json=None):
+        if method == 'post':
+            return self.api.call(self.api.batch_update, json, read=False)
+        return self.api.call(self.api.batch_get, params)
+
+
+class FakeGoogleClient:
+    """GoogleClient without credentials, authorizes to the fake API"""
+
+    def __init__(self, api, scheduler):
+        self.scheduler = scheduler
+        self.gc = FakeGspreadClient(api)
+
+    def authorize(self, stale=None):
+        return self.gc
+
+
+class FakeRole:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class FakeMember:
+    def __init__(self, id, name, guild, roles=()):
+        self.id = id
+        self.name = name
+        self.nick = None
+        self.guild = guild
+        self.roles = list(roles)
+        self.avatar_url = f'https://cdn.example.com/avatars/{id}.png'
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, id, roles=()):
+        self.id = id
+        self.roles = list(roles)
+        self.members = []
+
+    def get_member_named(self, name):
+        for member in self.members:
+            if name in (member.name, member.nick):
+                return member
+        return None
+
+
+class FakeChannel:
+    """Text channel that drops what is sent, after latency seconds"""
+
+    def __init__(self, id, guild, latency=0.0):
+        self.id = id
+        self.guild = guild
+        self.latency = latency
+        self.sent = 0
+        self.last = None
+
+    async def send(self, content=None, embed=None):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.last = content
+
+    async def trigger_typing(self):
+        await asyncio.sleep(self.latency)
+
+
+class FakeMessage:
+    def __init__(self, id, content, author, channel):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+
+
+class BenchBot(RedemptionBot):
+    """RedemptionBot that never logs in to discord"""
+
+    def start_bot(self):
+        pass
+
+
+def make_rows(count, rng):
+    """Header, count members and a blank row, in the sheet's layout"""
+    rows = [['RSN', 'Splits', 'Items', 'Join Date', 'Rank', '', 'Days', 'Manual Rank']]
+    for i in range(count):
+        items = 'Twisted bow x1' if rng.random() < 0.1 else ''
+        manual = 'Ex-Member' if rng.random() < 0.05 else ''
+        rows.append([
+            f'Player{i}', f'{rng.randrange(0, 500_000_000):,}', items, '1/1/2019',
+            'Member', '', str(rng.randrange(0, 1500)), manual
+        ])
+    rows.append(['', '', '', '', '', '', '', ''])
+    return rows
+
+
+def make_trace(count, names, mix, rng):
+    """Yields (kind, command text) with kinds picked by the weights in mix"""
+    kinds = [kind for kind in KINDS if mix.get(kind)]
+    weights = [mix[kind] for kind in kinds]
+    added = 0
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'check':
+            name = rng.choice(names)
+            # Some people type names in lower case or with a slip
+            if rng.random() < 0.1:
+                name = name.lower()
+            elif rng.random() < 0.05:
+                name = name[:-1]
+            yield kind, f'.check {name}'
+        elif kind == 'update':
+            # Loot splits often cover a few members at once
+            lines = rng.randint(2, 5) if rng.random() < 0.1 else 1
+            updates = []
+            for name in rng.sample(names, lines):
+                line = f'{name}, {rng.randrange(100_000, 50_000_000)}'
+                if rng.random() < 0.3:
+                    line += ', Dragon claws x1'
+                updates.append(line)
+            yield kind, '.update ' + '\n'.join(updates)
+        elif kind == 'add':
+            added += 1
+            yield kind, f'.add Recruit{added}, 0'
+        else:
+            yield kind, f'.remove {rng.choice(names)}'
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of values, 0 if there are none"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+async def run_command(bot, kind, message, results):
+    """Runs one message through the bot, recording latency and sheet calls"""
+    calls = [0]
+    _sheet_calls.set(calls)
+    command, msg = router.split(message.content)
+    start = time.perf_counter()
+    error = False
+    try:
+        await bot.check(command, msg, message)
+    except gspread.exceptions.APIError:
+        # on_message would tell the channel the API failed
+        error = True
+    results.append((kind, time.perf_counter() - start, calls[0], error))
+
+
+async def run_trace(bot, trace, channel, admin, rate, rng):
+    """Sends the trace at rate messages a second (all at once if 0)"""
+    results = []
+    tasks = []
+    for op_id, (kind, content) in enumerate(trace, 1):
+        message = FakeMessage(op_id, content, admin, channel)
+        tasks.append(asyncio.ensure_future(run_command(bot, kind, message, results)))
+        if rate:
+            # Messages arrive at random, rate a second on average
+            await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return results
+
+
+def bench(size, args):
+    """Runs one trace against a roster of size members, returns the results"""
+    rng = random.Random(args.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    workdir = tempfile.TemporaryDirectory(prefix='splitbot-bench-')
+
+    scheduler = SheetScheduler(
+        per_minute=args.quota or 10 ** 9,
+        base_delay=args.retry_delay,
+        max_delay=args.retry_delay * 16
+    )
+    api = FakeSheetsAPI(
+        make_rows(size, rng), latency=args.latency, per_row=args.per_row,
+        error_rate=args.error_rate, seed=args.seed
+    )
+    sheet = GoogleSheetBackend(
+        'https://docs.google.com/spreadsheets/d/bench', 'Splits',
+        client=FakeGoogleClient(api, scheduler)
+    )
+    write_behind = None
+    if args.write_behind:
+        write_behind = WriteBehind(os.path.join(workdir.name, 'pending_updates.jsonl'))
+    changes = ChangeLog(os.path.join(workdir.name, 'changes.jsonl'))
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='sheets')
+    doc = AsyncDocScanner(
+        DocScanner(
+            sheet, cache_ttl=args.cache_ttl, write_behind=write_behind, changes=changes,
+            connect=False
+        ),
+        executor=executor
+    )
+    docs = DocDirectory()
+    docs.add(doc)
+
+    admin_role = FakeRole(1, 'Admin')
+    guild = FakeGuild(1, [FakeRole(2, 'Member'), admin_role])
+    admin = FakeMember(1, 'Officer', guild, [admin_role])
+    # Most of the clan is on the discord too
+    names = [f'Player{i}' for i in range(size)]
+    guild.members = [admin] + [
+        FakeMember(i + 2, name, guild) for i, name in enumerate(names) if rng.random() < 0.8
+    ]
+    channel = FakeChannel(1, guild, latency=args.discord_latency)
+    bot = BenchBot(docs, {'Bot Token': '', 'Admin Rank': 'Admin'})
+    bot.members.build(guild)
+
+    output = io.StringIO()
+    quiet = contextlib.redirect_stdout(output) if not args.verbose else contextlib.nullcontext()
+    try:
+        with quiet:
+            start = time.perf_counter()
+            loop.run_until_complete(doc.warm_up(retry_delay=args.retry_delay))
+            load_time = time.perf_counter() - start
+            calls_before = api.calls
+
+            trace = list(make_trace(args.commands, names, args.mix, rng))
+            start = time.perf_counter()
+            results = loop.run_until_complete(
+                run_trace(bot, trace, channel, admin, args.rate, rng)
+            )
+            elapsed = time.perf_counter() - start
+            if write_behind is not None:
+                loop.run_until_complete(doc.flush())
+    finally:
+        executor.shutdown(wait=True)
+        changes.close()
+        if write_behind is not None:
+            write_behind.close()
+        loop.close()
+        workdir.cleanup()
+
+    return {
+        'size': size,
+        'load_time': load_time,
+        'elapsed': elapsed,
+        'results': results,
+        'sheet_calls': api.calls - calls_before,
+        'scheduler': scheduler.stats()
+    }
+
+
+def report(run):
+    results = run['results']
+    total = len(results)
+    errors = sum(1 for result in results if result[3])
+    print(
+        f"{run['size']:,} rows: roster loaded in {run['load_time']:.2f}s, "
+        f"{total:,} commands in {run['elapsed']:.2f}s "
+        f"({total / run['elapsed']:.1f}/s), {errors} failed, "
+        f"{run['scheduler']['retries']} retries"
+    )
+    print(f"  {'command':<8}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'sheet calls':>13}")
+    for kind in KINDS + ('all',):
+        picked = [result for result in results if kind in ('all', result[0])]
+        if not picked:
+            continue
+        latencies = [result[1] * 1000 for result in picked]
+        calls = sum(result[2] for result in picked) / len(picked)
+        print(
+            f"  {kind:<8}{len(picked):>7,}{percentile(latencies, 50):>10.1f}"
+            f"{percentile(latencies, 99):>10.1f}{calls:>13.2f}"
+        )
+    print()
+
+
+def parse_mix(text):
+    """Parses "check=80,update=15" into {kind: weight}"""
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f'Unknown command "{kind}" in mix')
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Bad weight for "{kind}" in mix')
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000, 50000],
+                        help='Roster sizes to run (default 100 1000 10000 50000)')
+    parser.add_argument('--commands', type=int, default=500,
+                        help='Commands per run (default 500)')
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='Messages a second, 0 sends the whole trace at once (default 20)')
+    parser.add_argument('--mix', type=parse_mix, default='check=80,update=15,add=3,remove=2',
+                        help='Command weights (default check=80,update=15,add=3,remove=2)')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Seconds per sheet call (default 0.1)')
+    parser.add_argument('--per-row', type=float, default=0.00002,
+                        help='Extra seconds per row for sheet reads (default 0.00002)')
+    parser.add_argument('--error-rate', type=float, default=0.01,
+                        help='Fraction of sheet calls failing with a quota error (default 0.01)')
+    parser.add_argument('--quota', type=int, default=0,
+                        help='Sheet calls allowed per minute, 0 for no limit (default 0)')
+    parser.add_argument('--retry-delay', type=float, default=0.05,
+                        help='Seconds to back off after the first quota error (default 0.05)')
+    parser.add_argument('--discord-latency', type=float, default=0.0,
+                        help='Seconds per discord call (default 0)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Sheet worker threads (default 4)')
+    parser.add_argument('--cache-ttl', type=float, default=60,
+                        help='Seconds the roster is cached (default 60)')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='Queue .update changes and write them in one batch at the end')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seeds the roster, trace and errors (default 1)')
+    parser.add_argument('--verbose', action='store_true',
+                        help="Shows the bot's own output")
+    args = parser.parse_args()
+
+    for size in args.rows:
+        report(bench(size, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from journal import Journal
+import threading
+import time
+import uuid
+
+
+class ChangeLog:
+    """Record of every change the bot makes to the roster
+
+    Each change is tagged with an op ID (the Discord message ID of the
+    command) and journaled before it is written, with the absolute values
+    it writes. Running the same op again, e.g. a retry after an API error,
+    finds it here instead of applying the change twice. The journal also
+    backs .history and .undo
+
+    Entries are dicts:
+    op: str - Op ID
+    kind: str - update, add, remove or undo
+    time: float - When the change was made (seconds since the epoch)
+    cells: list - [row, col, value] written to the sheet
+    names: list - [row, name] of the member on each row written, so a
+        retry can find them again if the sheet has been sorted
+    results: list - What the command returned, e.g. (name, prev_val,
+        new_val, old_items, new_items) per member for an update
+    done: bool - The write went through
+    undone_by: str - Op ID of the .undo that reverted it, if any
+
+    Parameters:
+    path: str - Journal file
+    keep: int - Ops remembered, older ones are dropped from the journal
+        when it is next loaded
+    sync_interval: float - Seconds between fsyncs of the journal
+
+    Methods:
+    --------
+    get(op: str):
+        The entry for op, or None if it hasn't been seen
+
+    begin(op: str, kind: str, cells: dict, results: list, names: dict):
+        Journals a change about to be written, returns its entry
+
+    done(entry: dict):
+        Marks entry as written
+
+    undone(entry: dict, by: str):
+        Marks entry as reverted by the undo op by
+
+    recent(count: int, kinds: tuple, undone: bool):
+        The last count written entries of those kinds, newest first.
+        Entries that were undone are skipped unless undone is set
+
+    close():
+        Syncs and closes the journal
+    """
+
+    def __init__(self, path, keep=1000, sync_interval=1.0):
+        self.keep = keep
+        # [op] = entry, oldest first
+        self.ops = OrderedDict()
+        self.lock = threading.Lock()
+        self.journal = Journal(path, sync_interval)
+        self._replay()
+
+    def _replay(self):
+        """Loads ops from the journal, compacting it if it has grown"""
+        lines = 0
+        for record in self.journal.entries():
+            lines += 1
+            entry = self.ops.get(record['op'])
+            if 'kind' in record:
+                self._remember(record)
+            elif entry is not None:
+                # Follow-up line, e.g. {"op": ..., "done": true}
+                entry.update(record)
+        if lines > 2 * self.keep:
+            self.journal.rewrite(self.ops.values())
+
+    def _remember(self, entry):
+        self.ops[entry['op']] = entry
+        while len(self.ops) > self.keep:
+            self.ops.popitem(last=False)
+
+    def get(self, op):
+        if op is None:
+            return None
+        with self.lock:
+            return self.ops.get(str(op))
+
+    def begin(self, op, kind, cells, results, names=None):
+        entry = {
+            'op': str(op) if op is not None else uuid.uuid4().hex,
+            'kind': kind,
+            'time': time.time(),
+            'cells': [[row, col, value] for (row, col), value in cells.items()],
+            'names': [[row, name] for row, name in (names or {}).items()],
+            'results': results,
+            'done': False
+        }
+        with self.lock:
+            self.journal.append(entry)
+            self._remember(entry)
+        return entry
+
+    def done(self, entry):
+        with self.lock:
+            self.journal.append({'op': entry['op'], 'done': True})
+            entry['done'] = True
+
+    def undone(self, entry, by):
+        with self.lock:
+            self.journal.append({'op': entry['op'], 'undone_by': by})
+            entry['undone_by'] = by
+
+    def recent(self, count, kinds=('update', 'add', 'remove'), undone=False):
+        found = []
+        with self.lock:
+            for entry in reversed(self.ops.values()):
+                if len(found) >= count:
+                    break
+                if entry['kind'] not in kinds or not entry['done']:
+                    continue
+                if undone or not entry.get('undone_by'):
+                    found.append(entry)
+        return found
+
+    def close(self):
+        self.journal.close()
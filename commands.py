@@ -0,0 +1,189 @@
+from datetime import datetime
+import re
+
+
+# A command is a "." followed by lower case letters or underscores
+COMMAND = re.compile(r'\.([a-z_]+)')
+DATE_FORMAT = re.compile(r'^[0-1]?[0-9]/[0-3]?[0-9]/20[0-9][0-9]$')
+
+
+class UsageError(Exception):
+    """Raised by a parser, the message is sent back to the channel"""
+
+
+class Context:
+    """Where a command came from, and the roster it works on"""
+
+    __slots__ = ('message', 'author', 'channel', 'guild', 'doc', 'event')
+
+    def __init__(self, message, doc=None):
+        self.message = message
+        self.doc = doc
+        self.author = message.author
+        self.channel = message.channel
+        # Direct messages have no guild
+        self.guild = getattr(message.channel, 'guild', None)
+        # Fields the handler adds to the command's event log entry
+        self.event = {}
+
+
+class Command:
+    """A registered command
+
+    Parameters:
+    name: str - Text after the "." (e.g. check)
+    handler: coroutine function - Called as handler(bot, ctx, *args)
+    parser: function - Turns the message text into handler args, raises
+        UsageError if it can't
+    admin: bool - Only members with the admin role may run it
+    delete: bool - Deletes the command message once it has run
+    """
+
+    __slots__ = ('name', 'handler', 'parser', 'admin', 'delete')
+
+    def __init__(self, name, handler, parser, admin=False, delete=False):
+        self.name = name
+        self.handler = handler
+        self.parser = parser
+        self.admin = admin
+        self.delete = delete
+
+
+class CommandRouter:
+    """Maps command names to their handlers
+
+    Methods:
+    --------
+    command(name: str, parser, admin: bool, delete: bool):
+        Decorator that registers a bot method as a command
+
+    split(content: str):
+        Returns (command name, rest of the message), or None if the
+        message isn't a command
+
+    get(name: str):
+        The Command registered under name, or None
+    """
+
+    def __init__(self):
+        self.commands = {}
+
+    def command(self, name, parser=None, admin=False, delete=False):
+        def register(handler):
+            self.commands[name] = Command(name, handler, parser or parse_none, admin, delete)
+            return handler
+        return register
+
+    def split(self, content):
+        # Cheap check first, most messages aren't commands
+        if not content.startswith('.'):
+            return None
+        match = COMMAND.match(content)
+        if match is None:
+            return None
+        return match.group(1), content[match.end():].strip()
+
+    def get(self, name):
+        return self.commands.get(name)
+
+
+def parse_none(msg):
+    return ()
+
+
+def parse_text(msg):
+    return (msg,)
+
+
+def parse_count(msg, default=10):
+    """Optional count for .top and .history, 10 if not given and at most 25"""
+    try:
+        count = int(msg) if msg else default
+    except ValueError:
+        raise UsageError('Incorrect format, see .splits_help')
+    return (max(1, min(count, 25)),)
+
+
+def parse_undo(msg):
+    """Optional count for .undo, 1 if not given"""
+    return parse_count(msg, default=1)
+
+
+def parse_update(line):
+    """Reads "<name>, <splits>, <items>" or "<name>: <splits>, <items>"
+    Returns (name, delta, items) or None if the splits aren't a number
+    """
+    # A colon only counts as the separator if it comes before any comma
+    head = line.split(',', 1)[0]
+    if ':' in head:
+        name, rest = line.split(':', 1)
+        inputs = [name] + rest.split(',')
+    else:
+        inputs = line.split(',')
+
+    name = inputs[0].strip()
+    try:
+        delta = int(inputs[1])
+    except(ValueError, TypeError, IndexError):
+        return None
+    # Gathers items
+    items = ', '.join(inputs[2:]).strip() if len(inputs) > 2 else None
+    return name, delta, items
+
+
+def parse_updates(msg):
+    """One update per line for .update
+    Returns (list of (name, delta, items), whether it was a multi-line update)
+    """
+    # One member per line updates them all together
+    if '\n' not in msg.strip():
+        parsed = parse_update(msg)
+        if parsed is None:
+            raise UsageError("Incorrect format, see .splits_help")
+        return [parsed], False
+
+    updates = []
+    for number, line in enumerate(msg.strip().splitlines(), 1):
+        if not line.strip():
+            continue
+        parsed = parse_update(line)
+        if parsed is None:
+            raise UsageError(f'Incorrect format on line {number}, see .splits_help')
+        updates.append(parsed)
+
+    # Discord embeds hold up to 25 fields
+    if len(updates) > 25:
+        raise UsageError('Too many lines, please update at most 25 members at once')
+    return updates, True
+
+
+def parse_add(msg):
+    """Reads "<name>, <splits>, <date>, <items>" for .add, last three optional"""
+    inputs = msg.split(',')
+    name = None
+    splits = 0
+    date = None
+    items = []
+
+    for i in range(len(inputs)):
+        if i == 0:
+            name = inputs[i].strip()
+            if name == '':
+                raise UsageError('I need a name (see .splits_help)')
+        elif i == 1:
+            try:
+                splits = int(inputs[i].strip())
+            except (ValueError, SyntaxError, TypeError, IndexError):
+                raise UsageError('Incorrect splits format (see .splits_help)')
+        elif i == 2:
+            check = DATE_FORMAT.match(inputs[i].strip())
+            if check is None:
+                raise UsageError('Incorrect date format (see .splits_help)')
+            date = check.group()
+            try:
+                datetime.strptime(date, r'%m/%d/%Y')
+            except ValueError:
+                raise UsageError('Incorrect date format (see .splits_help)')
+        else:
+            items.append(inputs[i])
+    return name, splits, date, ', '.join(items)
@@ -1,31 +1,109 @@
-from oauth2client.service_account import ServiceAccountCredentials
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date as Date
+from name_index import NameIndex
+from items import ItemInventory
+from leaderboard import Leaderboard
+from roster import COLUMNS, diff_roster, load_roster, parse_member
+from metrics import registry as metrics
 import gspread
-import re
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+
+
+class RosterFetch:
+    """One roster read from the backend that concurrent readers share"""
+
+    __slots__ = ('seq', 'generation', 'finished', 'rows', 'error')
+
+    def __init__(self, seq, generation):
+        self.seq = seq
+        # Write generation when the read started
+        self.generation = generation
+        self.finished = threading.Event()
+        self.rows = None
+        self.error = None
+
+    def wait(self):
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.rows
 
 
 class DocScanner:
     """DocScanner is used to pull and push updates to the required doc
     
     Parameters:
-    ss_URL: str - URL of the google sheet to access
-    ws_name: str - Name of the worksheet (or tab) on the google sheet
+    backend: SheetBackend - Where the roster is stored (see backends.py)
+    cache_ttl: int - Seconds the cached roster is trusted before re-reading
+    write_behind: WriteBehind - Optional queue that holds .update changes
+        until flush() is called, instead of writing each one straight away
+    changes: ChangeLog - Optional journal of every change, tagged with the
+        op ID (Discord message ID) of the command that made it
 
     Methods:
     --------
     connect_to_API():
-        Connects to the google sheet. Decorator set up to reconnect
+        Connects to the storage backend. Decorator set up to reconnect
         if connection was lost
 
-    get_all_splits():
+    warm_up():
+        Connects if that was left for later and fills the roster cache
+
+    get_all_splits(force: bool):
         Grabs full list of all splits as a dictionary in the form:
-        name = (row_number, splits_value, items, days, rank)
+        name = Member(row, splits, items, days, rank, manual_rank)
+        Served from the roster cache unless it is older than cache_ttl
+        or force is set. Concurrent reads share one fetch
+
+    refresh():
+        Reloads the roster cache from the sheet, returns the member count
+        and the set of names added, removed or changed since the last load
+
+    invalidate():
+        Marks the roster cache as stale so the next read reloads it
+
+    write_cells(cells: dict, echo: bool):
+        Writes {(row, col): value} to the sheet in a single batch update.
+        With echo set, returns the updated rows as read back by the API
 
     get_split(name: str):
         Returns the splits value for the specific user (exact match)
 
-    update_split(name: str, delta: int, items: str):
+    top_splits(count: int):
+        Returns the count highest (name, splits), Ex-Members left out
+
+    rank_of(name: str):
+        Returns (place, members on the board, splits) for name
+
+    find_member(name: str):
+        Returns the roster name closest to name, allowing for case and
+        spelling errors, or None if nothing is close enough
+
+    suggest_names(name: str):
+        Returns a short list of roster names similar to name
+
+    update_split(name: str, delta: int, items: str, op_id):
         Adds value of delta to user (name)'s splits. Also appends item list
-        based on provided string
+        based on provided string. In write-behind mode this only updates the
+        cache and queues the change
+
+    update_splits(updates: list, op_id):
+        update_split for a list of (name, delta, items), all checked against
+        one roster snapshot and written in a single batch
+
+    history(count: int):
+        The last count changes from the change log, newest first
+
+    undo(count: int, op_id):
+        Reverts the last count updates and removals in the change log,
+        stopping at an add
+
+    flush():
+        Writes all queued write-behind changes to the sheet in one update
 
     format_items(items: str):
         Formats a list of items into the required format
@@ -34,7 +112,7 @@ class DocScanner:
         3. Duplicate items combit with name, splits, date, and itemsned and denoted with (x#)
         e.g.: Sword of the Cliche, Thanoscopter Blade x3
 
-    add_user(name: str, splits: int, date: str, items: str):
+    add_user(name: str, splits: int, date: str, items: str, op_id):
         Adds user to spreadshee
         Later 3 parameters are optional
 
@@ -48,62 +126,245 @@ class DocScanner:
                 except gspread.exceptions.APIError:
                     print("API Error, attempting reconnect")
                     self.connect_to_API()
+                    try:
+                        return func(self, *args, **kwargs)
+                    except gspread.exceptions.APIError:
+                        # Sheet may be half written, don't trust the cache
+                        self.invalidate()
+                        raise
+            return wrapper
+
+        def synchronized(func):
+            # Read-modify-write methods run one at a time across threads
+            def wrapper(self, *args, **kwargs):
+                with self.lock:
                     return func(self, *args, **kwargs)
             return wrapper
 
-    def __init__(self, ss_URL: str, ws_name: str):
+    def __init__(self, backend, cache_ttl: int = 60, write_behind=None, changes=None,
+                 connect=True):
         """Initiates DocScanner class
         
         Parameters:
         -----------
-        ss_url: str
-            URL of the google doc
-        ws_name: str
-            Exact name of the specific worksheet within the google doc
-        """
-        self.ss_URL = ss_URL
-        self.ws_name = ws_name
-        # Grabs credentials and API information, connects to API
-        self.scope = [
-            'https://spreadsheets.google.com/feeds', 
-            'https://www.googleapis.com/auth/drive'
-        ]
-        self.creds = ServiceAccountCredentials.from_json_keyfile_name(
-            'credentials.json', 
-            self.scope
-        )
-        self.connect_to_API()
+        backend: SheetBackend
+            Google sheet, SQLite or in-memory storage for the roster
+        cache_ttl: int
+            Seconds before the cached roster is re-read from the sheet
+        write_behind: WriteBehind
+            Queue for delayed .update writes, None writes straight through
+        changes: ChangeLog
+            Journal of changes made, for retries, .history and .undo
+        connect: bool
+            Opens the backend straight away, otherwise warm_up() does it
+        """
+        self.backend = backend
+        # Roster cache, filled on first read
+        self.cache_ttl = cache_ttl
+        self._roster = None
+        self._roster_time = 0
+        # Last roster installed, kept through invalidate() to diff against
+        self._installed = {}
+        # [row] = (hash of its cells, name, Member) from the last read
+        self._loaded = {}
+        self.lock = threading.RLock()
+        # Reads in flight are shared, see get_all_splits
+        self._fetch = None
+        self._fetch_seq = 0
+        self._installed_seq = 0
+        # Bumped by every write, a read started before one isn't cached
+        self._generation = 0
+        self._fetch_lock = threading.Lock()
+        self.names = NameIndex()
+        self.leaderboard = Leaderboard()
+        # [name] = (item column text, ItemInventory parsed from it)
+        self._inventories = {}
+        self.write_behind = write_behind
+        self.changes = changes
+        self.connected = False
+        if connect:
+            self.connect_to_API()
 
     def connect_to_API(self):
-        """Opens the document and assigns worksheet to instance variable"""
-        gc = gspread.authorize(self.creds)
-        self.sheet = gc.open_by_url(self.ss_URL).worksheet(self.ws_name)
+        """Opens the backend, e.g. the document and worksheet"""
+        self._sheet('connect')
+        self.connected = True
+
+    def warm_up(self):
+        """Connects if needed and loads the roster and its indexes,
+        finishing any write-behind flush a restart cut short
+        Returns the number of members
+        """
+        if not self.connected:
+            self.connect_to_API()
+        if self.write_behind is not None and self.write_behind.flushing:
+            self.flush()
+        return len(self.get_all_splits(force=True))
+
+    def _sheet(self, method, *args, **kwargs):
+        """Calls a backend method, timing it and counting errors"""
+        with metrics.timer('sheet_call_seconds', method=method):
+            try:
+                return getattr(self.backend, method)(*args, **kwargs)
+            except Exception:
+                metrics.inc('sheet_errors_total', method=method)
+                raise
+
+    def get_all_splits(self, force=False):
+        """Gets all characters and split values, cached for cache_ttl seconds
+
+        Readers that miss the cache at the same time wait on a single
+        fetch. The fetch runs without holding the write lock, and is only
+        used if no write finished while it was running
+        """
+        if not force and not self._cache_stale():
+            metrics.inc('roster_cache_total', result='hit')
+            return self._roster
+        metrics.inc('roster_cache_total', result='miss')
+        return self._load(force)[0]
+
+    def _load(self, force):
+        """Reads the roster through a shared fetch
+        Returns (roster, changed names), changed is empty unless this
+        call's fetch was the one installed
+        """
+        while True:
+            fetch = self._join_fetch(force)
+            rows = fetch.wait()
+            with self.lock, self._fetch_lock:
+                if fetch.generation == self._generation:
+                    # First reader back installs it, unless a newer read
+                    # already has
+                    changed = set()
+                    if fetch.seq > self._installed_seq:
+                        self._installed_seq = fetch.seq
+                        changed = self._install(self._apply_pending(rows))
+                    if self._roster is not None:
+                        return self._roster, changed
+                elif self._roster is not None:
+                    # A write finished during the fetch, the cache has it
+                    return self._roster, set()
+            # Cache was invalidated during the fetch, reads again
+            force = True
+
+    def _join_fetch(self, force):
+        """Returns the fetch in flight, starting one if there isn't one
+        that began after the latest write (or after this call, if forced)
+        """
+        with self._fetch_lock:
+            fetch = self._fetch
+            if (not force and fetch is not None 
+                    and fetch.generation == self._generation):
+                metrics.inc('roster_fetches_total', shared='yes')
+                return fetch
+            self._fetch_seq += 1
+            fetch = self._fetch = RosterFetch(self._fetch_seq, self._generation)
+        metrics.inc('roster_fetches_total', shared='no')
+
+        try:
+            fetch.rows = self.load_all_splits()
+        except BaseException as error:
+            fetch.error = error
+        finally:
+            with self._fetch_lock:
+                if self._fetch is fetch:
+                    self._fetch = None
+            fetch.finished.set()
+        return fetch
+
+    def _wrote(self):
+        """Marks a write, so reads started before it aren't cached"""
+        with self._fetch_lock:
+            self._generation += 1
+
+    def _install(self, splits_list):
+        """Makes splits_list the cached roster and updates the indexes
+        Returns the names that changed since the last install
+        """
+        previous = self._installed
+        self._roster = self._installed = splits_list
+        self._roster_time = time.monotonic()
+        if not previous:
+            # First load, building in bulk is quicker
+            self.names.update(splits_list.keys())
+            self.leaderboard.update({
+                name: member.splits 
+                for name, member in splits_list.items() if not member.ex_member
+            })
+            return set(splits_list)
+
+        # Only touches what changed, e.g. a row edited by hand
+        changed = diff_roster(previous, splits_list)
+        for name in changed:
+            member = splits_list.get(name)
+            if member is None:
+                self.names.discard(name)
+                self.leaderboard.discard(name)
+                self._inventories.pop(name, None)
+            else:
+                self.names.add(name)
+                if member.ex_member:
+                    self.leaderboard.discard(name)
+                else:
+                    self.leaderboard.set(name, member.splits)
+        return changed
+
+    def _cache_stale(self):
+        age = time.monotonic() - self._roster_time
+        return self._roster is None or age > self.cache_ttl
+
+    def _apply_pending(self, splits_list):
+        """Lays queued write-behind changes over a fresh sheet read"""
+        if not self.write_behind:
+            return splits_list
+        for name in self.write_behind.pending:
+            if name in splits_list:
+                member = splits_list[name]
+                amount, items = self.write_behind.apply(name, member.splits, member.items)
+                splits_list[name] = member.replace(splits=amount, items=items)
+        return splits_list
+
+    def refresh(self):
+        """Forces a reload of the roster
+        Returns (number of members, names that changed)
+        """
+        metrics.inc('roster_cache_total', result='miss')
+        roster, changed = self._load(True)
+        return len(roster), changed
+
+    def invalidate(self):
+        """Drops the cached roster so the next read goes to the sheet"""
+        with self._fetch_lock:
+            self._generation += 1
+            self._roster = None
 
     @Decor.reconnect
-    def get_all_splits(self):
+    def load_all_splits(self):
         """Gets all characters and split values from spreadsheet"""
-        # Grabs all values from sheet
-        all_vals = self.sheet.get_all_values()       
-
-        # Creates dictionary with a tuple of values
-        # [name] = (Row Index, Split Value, Items, Date, Rank)
-        # If split cannot be made proper integer, returns None for ammount
-        values = {}
-        for i in range(len(all_vals)):
-            col = all_vals[i]
-            name = col[0]
-            split = col[1]
-            items = col[2]
-            days = col[6]
-            rank = col[4]
-            if name:
-                try:
-                    amount = int(split.replace(",", "").replace("$", ""))
-                except (ValueError, IndexError):
-                    amount = None
-                if amount is not None:
-                    values[name] = (i + 1, amount, items, days, rank)
-        return values
+        # Grabs only the columns the roster uses, in one read
+        columns = self._sheet('get_columns', COLUMNS)
+
+        # [name] = Member(row, splits, items, days, rank, manual_rank)
+        # Rows that haven't changed since the last read aren't parsed again
+        roster, self._loaded = load_roster(columns, self._loaded)
+        return roster
+
+    @staticmethod
+    def _parse_row(row, col):
+        """Turns one full sheet row into (name, Member)
+        Returns None for blank names or splits that aren't a proper integer
+        """
+        # API responses drop trailing empty cells
+        col = list(col) + [''] * (8 - len(col))
+        return parse_member(row, col[0], col[1], col[2], col[4], col[6], col[7])
+
+    @Decor.reconnect
+    def write_cells(self, cells, echo=False):
+        """Writes {(row, col): value} as one batch through the backend
+        Cells between the given ones that aren't given are left as they are.
+        With echo, returns {row: [values]} for the rows after the write
+        """
+        return self._sheet('update_cells', cells, echo=echo)
 
     @Decor.reconnect
     def get_split(self, name):
@@ -113,135 +374,692 @@ class DocScanner:
         if name in splits_list:
             return splits_list[name]
 
-    @Decor.reconnect
-    def update_split(self, name, delta, items=None):
+    def top_splits(self, count=10):
+        """Highest splits first, without Ex-Members"""
+        self.get_all_splits()
+        return self.leaderboard.top(count)
+
+    def rank_of(self, name):
+        """Returns (place, board size, splits) or None if name isn't ranked"""
+        self.get_all_splits()
+        place = self.leaderboard.rank(name)
+        if place is None:
+            return None
+        return place, len(self.leaderboard), self.leaderboard.splits.get(name, 0)
+
+    def find_member(self, name):
+        """Finds the roster name matching name, forgiving small typos"""
+        splits_list = self.get_all_splits()
+        if name in splits_list:
+            return name
+        return self.names.best(name)
+
+    def suggest_names(self, name, limit=3):
+        """Lists roster names close to name for "did you mean" replies"""
+        self.get_all_splits()
+        return self.names.suggest(name, limit=limit)
+
+    def update_split(self, name, delta, items=None, op_id=None):
         """Adds value of delta to name's split"""
-        # Generates list
+        results, missing = self.update_splits([(name, delta, items)], op_id)
+        if missing:
+            return None
+
+        # Returns both previous and new value
+        return results[0][1:]
+
+    @Decor.synchronized
+    @Decor.reconnect
+    def update_splits(self, updates, op_id=None):
+        """Applies a list of (name, delta, items) updates as one write
+        Returns (results, missing). Each result is (name, prev_val, new_val,
+        old_items, new_items). If any names aren't on the sheet nothing is
+        written, results is None and missing lists those names.
+        Running an op_id again returns its first results without
+        applying the updates twice
+        """
+        entry = self.changes.get(op_id) if self.changes else None
+        if entry is not None:
+            return self._redo(entry), []
+
+        # Checks every name against the same roster snapshot
         splits_list = self.get_all_splits()
+        missing = [name for name, _, _ in updates if name not in splits_list]
+        if missing:
+            return None, missing
 
-        if name not in splits_list:
+        # The cache can be cache_ttl old, so a write starts from the
+        # values on the sheet in case they were edited by hand since.
+        # Queued changes are added to a fresh read when they're flushed
+        if self.write_behind is None:
+            splits_list, current = self._read_members(splits_list, [name for name, _, _ in updates])
+            missing = [name for name, _, _ in updates if name not in current]
+            if missing:
+                return None, missing
+        else:
+            current = splits_list
+
+        # Works on copies so nothing changes if the write fails
+        rows = {}
+        inventories = {}
+        cells = {}
+        names = {}
+        results = []
+        for name, delta, items in updates:
+            member = rows.get(name, current[name])
+            names[member.row] = name
+
+            # Adds provided value to splits
+            prev_val = member.splits
+            new_val = prev_val + delta
+            cells[(member.row, 2)] = new_val
+
+            # If item provided, appends item to end of item list
+            old_items = new_items = None
+            cached_items = member.items
+            if items is not None:
+                old_items = member.items
+
+                # Only the new items are parsed, the rest are already counted
+                if name not in inventories:
+                    inventories[name] = self._inventory(name, old_items).copy()
+                new_items = str(inventories[name].add(items))
+                cells[(member.row, 3)] = new_items
+                cached_items = new_items
+
+            rows[name] = member.replace(splits=new_val, items=cached_items)
+            results.append((name, prev_val, new_val, old_items, new_items))
+
+        # All rows go out in one call, or wait for the next flush
+        entry = self._begin(op_id, 'update', cells, results, names)
+        if self.write_behind is not None:
+            for name, delta, items in updates:
+                self.write_behind.add(name, delta, items)
+        else:
+            self.write_cells(cells)
+        self._done(entry)
+
+        # Write-through so the cache matches the sheet
+        self._write_through(splits_list, rows)
+        for name, inventory in inventories.items():
+            self._inventories[name] = (rows[name].items, inventory)
+        return results, []
+
+    def _read_members(self, splits_list, names):
+        """Reads names' rows from the sheet, found by their cached row
+        Returns (roster, {name: Member}) with the fresh records. If a row
+        no longer holds the member it did, e.g. the sheet was sorted, the
+        whole roster is read again instead
+        """
+        if not names:
+            return splits_list, {}
+        rows = {name: splits_list[name].row for name in names}
+        values = self._sheet('get_rows', rows.values())
+        current = {}
+        for name, row in rows.items():
+            parsed = self._parse_row(row, values.get(row, []))
+            if parsed is None or parsed[0] != name:
+                break
+            current[name] = parsed[1]
+        else:
+            return splits_list, current
+
+        # Rows have moved since the roster was read
+        self.invalidate()
+        splits_list = self.get_all_splits(force=True)
+        return splits_list, {name: splits_list[name] for name in names if name in splits_list}
+
+    def _moved_cells(self, entry):
+        """The cells a journaled change wrote, moved to the rows its
+        members are on now. Cells of members no longer on the sheet are
+        left out
+        """
+        names = {row: name for row, name in entry.get('names', [])}
+        splits_list = self.get_all_splits()
+        found = {name for name in names.values() if name in splits_list}
+        _, current = self._read_members(splits_list, list(found))
+        cells = {}
+        for row, col, value in entry['cells']:
+            member = current.get(names.get(row))
+            if member is not None:
+                cells[(member.row, col)] = value
+        return cells
+
+    def _write_through(self, splits_list, rows):
+        """Puts written members into the cache and the leaderboard"""
+        splits_list.update(rows)
+        for name, member in rows.items():
+            if member.ex_member:
+                self.leaderboard.discard(name)
+            else:
+                self.leaderboard.set(name, member.splits)
+        self._wrote()
+
+    def _begin(self, op_id, kind, cells, results, names=None):
+        """Journals a change before it is written, if there's a change log
+        names is {row: name} for the members written
+        """
+        if self.changes is None:
             return None
-        splits_vals = splits_list[name]
+        return self.changes.begin(op_id, kind, cells, results, names)
 
-        # If index is valid, adds provided value to splits
-        prev_val = splits_vals[1]
-        new_val = prev_val + delta
-        self.sheet.update_cell(splits_vals[0], 2, new_val)
+    def _done(self, entry):
+        if entry is not None:
+            self.changes.done(entry)
 
-        # If item provided, appends item to end of item list
-        old_items = new_items = None
-        if items is not None:
-            old_items = splits_vals[2]
+    def _redo(self, entry):
+        """Finishes an update op seen before and returns its results
+        An op that never finished writes the same absolute values again,
+        so applying it twice can't add the change twice. They go to the
+        members' rows as they are now, in case the sheet was sorted
+        """
+        results = [tuple(result) for result in entry['results']]
+        if entry['done']:
+            return results
+        if self.write_behind is not None:
+            # Queued changes are journaled by the write-behind queue itself
+            self._done(entry)
+            return results
 
-            if old_items:
-                new_item_list = old_items + ", " + items
-                new_items = self.format_items(new_item_list)  # Format list
-            else: 
-                new_items = self.format_items(items)
-            self.sheet.update_cell(splits_vals[0], 3, new_items)
+        cells = self._moved_cells(entry)
+        if cells:
+            self.write_cells(cells)
+        self._done(entry)
+        splits_list = self.get_all_splits()
+        rows = {}
+        for name, _, new_val, _, new_items in results:
+            member = splits_list.get(name)
+            if member is not None:
+                if new_items is None:
+                    new_items = member.items
+                rows[name] = member.replace(splits=new_val, items=new_items)
+        self._write_through(splits_list, rows)
+        return results
 
-        # Returns both previous and new value
-        return prev_val, new_val, old_items, new_items
+    def history(self, count=10):
+        """The last count changes, newest first, including undone ones"""
+        if self.changes is None:
+            return []
+        return self.changes.recent(count, ('update', 'add', 'remove', 'undo'), undone=True)
+
+    @Decor.synchronized
+    @Decor.reconnect
+    def undo(self, count=1, op_id=None):
+        """Reverts the last count updates and removals, newest first
+
+        Splits have the update's delta taken back off, so later changes
+        to the same member are kept. Items go back to what they were only
+        if nothing has changed them since. Adds can't be undone, so undo
+        stops at the newest one. Returns (undone entries, the add entry
+        it stopped at or None)
+        """
+        if self.changes is None:
+            return [], None
+        entry = self.changes.get(op_id)
+        if entry is not None:
+            return self._redo_undo(entry), None
+
+        targets = []
+        stopped = None
+        for target in self.changes.recent(count, ('update', 'add', 'remove')):
+            if target['kind'] == 'add':
+                # Changes older than the add are left alone
+                stopped = target
+                break
+            targets.append(target)
+        if not targets:
+            return [], stopped
+
+        # Items can only be put back once queued changes are on the sheet
+        self.flush()
+
+        # The cache can be cache_ttl old, so the members' rows are read
+        # fresh by name in case the sheet was sorted or edited since
+        splits_list = self.get_all_splits()
+        names = {result[0] for target in targets for result in target['results']}
+        splits_list, current = self._read_members(
+            splits_list, [name for name in names if name in splits_list]
+        )
+        rows = {}
+        cells = {}
+        written = {}
+        for target in targets:
+            if target['kind'] == 'update':
+                for name, prev_val, new_val, old_items, new_items in reversed(target['results']):
+                    member = rows.get(name, current.get(name))
+                    if member is None:
+                        continue
+                    splits = member.splits - (new_val - prev_val)
+                    cells[(member.row, 2)] = splits
+                    items = member.items
+                    if new_items is not None and member.items == new_items:
+                        items = old_items
+                        cells[(member.row, 3)] = items
+                    rows[name] = member.replace(splits=splits, items=items)
+                    written[member.row] = name
+            else:
+                name, manual_rank = target['results'][0]
+                member = rows.get(name, current.get(name))
+                if member is None:
+                    continue
+                cells[(member.row, 8)] = manual_rank
+                rows[name] = member.replace(manual_rank=manual_rank)
+                written[member.row] = name
+
+        entry = self._begin(op_id, 'undo', cells, [target['op'] for target in targets], written)
+        if cells:
+            self.write_cells(cells)
+        self._done(entry)
+        for target in targets:
+            self.changes.undone(target, entry['op'])
+
+        self._write_through(splits_list, rows)
+        if any(target['kind'] == 'remove' for target in targets):
+            # Rank is derived from the manual rank, re-read it next time
+            self.invalidate()
+        return targets, stopped
+
+    def _redo_undo(self, entry):
+        """Finishes an undo op seen before and returns its targets
+        An undo that never finished writes the values it worked out the
+        first time again, rather than taking the changes off twice. They
+        go to the members' rows as they are now
+        """
+        targets = [self.changes.get(op) for op in entry['results']]
+        targets = [target for target in targets if target is not None]
+        if entry['done']:
+            return targets
+
+        cells = self._moved_cells(entry)
+        if cells:
+            self.write_cells(cells)
+        self._done(entry)
+        for target in targets:
+            if not target.get('undone_by'):
+                self.changes.undone(target, entry['op'])
+        # The cache was never given the undone values
+        self.invalidate()
+        return targets
+
+    @Decor.synchronized
+    def flush(self):
+        """Writes queued write-behind changes in one batch
+        Returns the number of members written
+        """
+        if self.write_behind is None:
+            return 0
+        if not self.write_behind and not self.write_behind.flushing:
+            return 0
+
+        # Finishes a flush the last run was stopped in the middle of. Its
+        # cells hold absolute values, so writing them again is safe
+        if self.write_behind.flushing:
+            self.write_cells(self.write_behind.flushing)
+
+        # Starts from a fresh read so hand edits since the last
+        # refresh aren't written over
+        splits_list = self.load_all_splits()
+        cells = {}
+        for name in self.write_behind.pending:
+            if name not in splits_list:
+                print(f'Dropping pending update for "{name}", not on the sheet')
+                continue
+            member = splits_list[name]
+            new_val, new_items = self.write_behind.apply(name, member.splits, member.items)
+            cells[(member.row, 2)] = new_val
+            if new_items != member.items:
+                cells[(member.row, 3)] = new_items
+            splits_list[name] = member.replace(splits=new_val, items=new_items)
+
+        if cells:
+            self.write_behind.begin_flush(cells)
+            self.write_cells(cells)
+        count = len(self.write_behind)
+        self.write_behind.clear()
+
+        # The sheet now matches the merged values
+        self._install(splits_list)
+        self._wrote()
+        return count
 
-    def format_items(self, items):
+    def _inventory(self, name, items):
+        """Parsed items for name, reused while the column text is unchanged"""
+        cached = self._inventories.get(name)
+        if cached is not None and cached[0] == items:
+            metrics.inc('inventory_cache_total', result='hit')
+            return cached[1]
+        metrics.inc('inventory_cache_total', result='miss')
+        inventory = ItemInventory(items)
+        self._inventories[name] = (items, inventory)
+        return inventory
+
+    @staticmethod
+    def format_items(items):
         """Formats item list correctly. 
         Single items are listed as is (e.g. Sword of the Cliche)
         Duplicate items are added and noted (e.g. Sword of the Cliche x4)
         """
+        return str(ItemInventory(items))
 
-        def proper_case(string):
-            # Properly format item name
-            words = string.split(' ')
-            exceptions = ['a', 'an', 'of', 'the', 'is']
-            formatted = [words[0].title()]
-
-            for word in words[1:]:
-                appender = word.title() if word not in exceptions else word
-                formatted.append(appender)
-            return " ".join(formatted)
-
-        # Collect list and count of all items
-        all_items = items.split(',')
-        item_count = {}
-
-        # Count the number of items and format the name correctly
-        for item in all_items:
-            item = item.strip().lower()
-            count_mark = re.search(r" x[0-9]+$", item)
-
-            # Determines if item currently as "x[0-9]+ and counts appropriately"
-            if count_mark: 
-                count_mark_S = count_mark.group()
-                item = proper_case(item.replace(count_mark_S, ""))
-                count_S = re.search(r"[0-9]+", count_mark_S)
-                count = int(count_S.group())
-            else:
-                item = proper_case(item)
-                count = 1
-            
-            if item in item_count:
-                item_count[item] += count
-            else:
-                item_count[item] = count
-        
-        # Creates list with proper form
-        final_out = []
-        for item, count in item_count.items():
-            # Adds formatting
-            final = item if count == 1 else f'{item} x{str(count)}'
-            final_out.append(final)
-        
-        # Joins together as comma separated list
-        return ', '.join(final_out)
-
+    @Decor.synchronized
     @Decor.reconnect
-    def add_user(self, name, splits=0, date=None, items=''):
+    def add_user(self, name, splits=0, date=None, items='', op_id=None):
         """Adds user with optional splits, date, and items list"""
+        entry = self.changes.get(op_id) if self.changes else None
+        if entry is not None and entry['done']:
+            return self.get_split(name)
+
+        # Reads the name column fresh rather than from the cache, so a row
+        # added by hand since the last refresh is never written over
+        col_list = self._sheet('col_values', 1)
 
         # Confirm if user exists, breaks if it does
-        splits_list = self.get_all_splits()
-        if name in splits_list:
+        if name in col_list:
+            if entry is not None:
+                # This op added them but didn't get to mark it done
+                self._done(entry)
+                self.invalidate()
+                return self.get_split(name)
             return
 
         # If user does not exist, add to bottom with split
-
-        # Gets row for the end of the list
-        col_list = self.sheet.col_values(1)
         row = len(col_list) + 1
 
-        # Updates names, splits and items based on provided values
-        self.sheet.update_cell(row, 1, name)
-        self.sheet.update_cell(row, 2, splits)
-        formatted_items = self.format_items(items)
-        self.sheet.update_cell(row, 3, formatted_items)
-
-        # If date is not provided, uses the existing cell value TODAY()
-        # Replaces the function in the cell with the value
+        # If date is not provided, uses today's date in place of the
+        # sheet's TODAY() so it doesn't need reading first
         if date is None:
-            date = self.sheet.cell(row, 4).value
-        self.sheet.update_cell(row, 4, date)
+            today = Date.today()
+            date = f'{today.month}/{today.day}/{today.year}'
+
+        # Writes name, splits, items and date in one call. The range runs
+        # to column G so the echo carries the rank and days formulas
+        formatted_items = self.format_items(items)
+        cells = {
+            (row, 1): name,
+            (row, 2): splits,
+            (row, 3): formatted_items,
+            (row, 4): date,
+            (row, 7): None
+        }
+        if entry is None:
+            entry = self._begin(op_id, 'add', cells, [[name, splits]])
+        updated = self.write_cells(cells, echo=True)
+        self._done(entry)
 
-        # Confirms user was added
-        return self.get_split(name)
+        # Confirms user was added, without re-reading the sheet
+        parsed = self._parse_row(row, updated[row])
+        if parsed is None:
+            self.invalidate()
+            return self.get_split(name)
+        if self._roster is not None:
+            self._roster[name] = parsed[1]
+            self.names.add(name)
+            self.leaderboard.set(name, parsed[1].splits)
+        self._wrote()
+        return parsed[1]
 
+    @Decor.synchronized
     @Decor.reconnect
-    def remove_user(self, name):
+    def remove_user(self, name, op_id=None):
         """Marked member as ex-member"""
+        entry = self.changes.get(op_id) if self.changes else None
+        if entry is not None and entry['done']:
+            return True
+
         # Generates list
         splits_list = self.get_all_splits()
 
         if name not in splits_list:
             return None
-        splits_vals = splits_list[name]
+
+        # The cached row can be cache_ttl old, e.g. from before a sort,
+        # so the row is checked on the sheet before it is written
+        splits_list, current = self._read_members(splits_list, [name])
+        if name not in current:
+            return None
+        member = current[name]
 
         # If index is valid, sets member to Ex-Member
-        self.sheet.update_cell(splits_vals[0], 8, "Ex-Member")
+        cells = {(member.row, 8): "Ex-Member"}
+        if entry is None:
+            # Keeps the old manual rank so .undo can put it back
+            entry = self._begin(
+                op_id, 'remove', cells, [[name, member.manual_rank]], {member.row: name}
+            )
+        self.write_cells(cells)
+        self._done(entry)
+        self.leaderboard.discard(name)
+
+        # Rank is derived from the manual rank, re-read it next time
+        self.invalidate()
         return True
 
 
+class AsyncDocScanner:
+    """Async facade over DocScanner for use inside the discord event loop
+
+    Sheet calls run on a bounded thread pool and are awaited, so a slow
+    gspread request no longer stalls every other message
+
+    Parameters:
+    doc: DocScanner - Scanner doing the actual sheet work
+    workers: int - Max number of sheet calls in flight at once
+    executor: ThreadPoolExecutor - Pool shared with other rosters, a new
+        one with workers threads is made if not given
+    sync: SheetSync - Keeps a SQLite roster in step with its sheet
+    """
+
+    def __init__(self, doc, workers=4, executor=None, sync=None):
+        self.doc = doc
+        self.sync = sync
+        # Set once warm_up has loaded the roster, or given up
+        self.ready = asyncio.Event()
+        self.error = None
+        # Set once the roster has loaded, even if warm_up gave up first
+        self.loaded = asyncio.Event()
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=workers, 
+                thread_name_prefix='sheets'
+            )
+        self.executor = executor
+
+    async def run(self, func, *args, **kwargs):
+        """Runs func on the sheet thread pool and awaits its result"""
+        loop = asyncio.get_event_loop()
+        call = functools.partial(func, *args, **kwargs)
+        # Carries the command's metrics trace over to the worker thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, context.run, call)
+
+    async def warm_up(self, retry_delay=30, max_failures=5):
+        """Opens the sheet and loads the roster in the background
+        Runs alongside the discord login, commands wait on ready. API
+        errors are retried until they clear. After max_failures of
+        anything else (e.g. no network yet) commands are told the roster
+        is unavailable, but it keeps retrying so a short outage at start
+        up doesn't need a restart
+        """
+        failures = 0
+        while True:
+            try:
+                count = await self.run(self.doc.warm_up)
+            except (gspread.exceptions.NoValidUrlKeyFound, 
+                    gspread.exceptions.WorksheetNotFound) as error:
+                # Bad URL or worksheet name, retrying won't help
+                print(f"ERROR: Roster could not be loaded ({error!r}), please check the configs")
+                self.error = error
+                self.ready.set()
+                return
+            except gspread.exceptions.APIError:
+                print(f"API Error while loading the roster, retrying in {retry_delay}s")
+                await asyncio.sleep(retry_delay)
+                continue
+            except Exception as error:
+                failures += 1
+                if failures == max_failures:
+                    print(f"ERROR: Roster could not be loaded ({error!r}), "
+                          f"still retrying every {retry_delay}s")
+                    self.error = error
+                    self.ready.set()
+                else:
+                    print(f"Error while loading the roster ({error!r}), retrying in {retry_delay}s")
+                await asyncio.sleep(retry_delay)
+                continue
+            print(f"Roster loaded ({count:,} members)")
+            self.error = None
+            self.ready.set()
+            self.loaded.set()
+            return
+
+    async def wait_ready(self, timeout=None):
+        """Waits for warm_up, returns False if the roster couldn't be loaded
+        Raises asyncio.TimeoutError if it is still loading after timeout
+        seconds
+        """
+        await asyncio.wait_for(self.ready.wait(), timeout)
+        return self.error is None
+
+    async def get_split(self, name):
+        return await self.run(self.doc.get_split, name)
+
+    async def top_splits(self, count=10):
+        return await self.run(self.doc.top_splits, count)
+
+    async def rank_of(self, name):
+        return await self.run(self.doc.rank_of, name)
+
+    async def find_member(self, name):
+        return await self.run(self.doc.find_member, name)
+
+    async def suggest_names(self, name, limit=3):
+        return await self.run(self.doc.suggest_names, name, limit)
+
+    async def update_split(self, name, delta, items=None, op_id=None):
+        return await self.run(self.doc.update_split, name, delta, items, op_id)
+
+    async def update_splits(self, updates, op_id=None):
+        return await self.run(self.doc.update_splits, updates, op_id)
+
+    async def add_user(self, name, splits=0, date=None, items='', op_id=None):
+        return await self.run(self.doc.add_user, name, splits, date, items, op_id)
+
+    async def remove_user(self, name, op_id=None):
+        return await self.run(self.doc.remove_user, name, op_id)
+
+    async def history(self, count=10):
+        return await self.run(self.doc.history, count)
+
+    async def undo(self, count=1, op_id=None):
+        return await self.run(self.doc.undo, count, op_id)
+
+    async def refresh(self):
+        return await self.run(self.doc.refresh)
+
+    async def flush(self):
+        return await self.run(self.doc.flush)
+
+    async def flush_forever(self, interval):
+        """Flushes write-behind changes every interval seconds"""
+        await self.loaded.wait()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                count = await self.flush()
+            except gspread.exceptions.APIError:
+                # Changes stay queued and journaled for the next attempt
+                print("API Error while flushing pending updates")
+                continue
+            except Exception as error:
+                # e.g. no network, the journal keeps a retry from
+                # applying anything twice
+                print(f"Error while flushing pending updates ({error!r})")
+                continue
+            if count:
+                print(f'Flushed pending updates for {count} members')
+
+    async def sync_forever(self, sync, interval):
+        """Runs a SheetSync pass once the local roster has loaded, then
+        every interval seconds. Commands don't wait for it, so the bot
+        works from the local roster while the sheet can't be reached
+        """
+        await self.loaded.wait()
+        while True:
+            try:
+                # Pulled values reach the cache through sync.invalidate
+                await self.run(sync.sync)
+            except gspread.exceptions.APIError:
+                # Unsynced changes are picked up again on the next pass
+                print("API Error while syncing with the sheet")
+            except Exception as error:
+                # e.g. no network, the next pass tries again
+                print(f"Error while syncing with the sheet ({error!r})")
+            await asyncio.sleep(interval)
+
+    def sheet_stats(self):
+        """Queue depth and wait times from the backend, if it has any"""
+        return self.doc.backend.stats()
+
+    def shutdown(self):
+        """Waits for in-flight sheet calls and stops the thread pool"""
+        self.executor.shutdown(wait=True)
+
+
+class DocDirectory:
+    """Which roster each guild or channel uses
+
+    Lets one bot serve several clans, each with their own sheet. A
+    channel's own roster wins over its guild's, and anything not listed
+    uses the default roster (if there is one)
+
+    Methods:
+    --------
+    add(doc: AsyncDocScanner, guild: int, channel: int):
+        Routes a guild or channel ID to doc, neither makes it the default
+
+    doc_for(channel: discord.abc.Messageable):
+        The roster for messages in channel, or None
+
+    iter(directory):
+        Each roster once
+    """
+
+    def __init__(self):
+        self.default = None
+        self.guilds = {}
+        self.channels = {}
+        self.docs = []
+
+    def add(self, doc, guild=None, channel=None):
+        if channel is not None:
+            self.channels[int(channel)] = doc
+        elif guild is not None:
+            self.guilds[int(guild)] = doc
+        else:
+            self.default = doc
+        if doc not in self.docs:
+            self.docs.append(doc)
+
+    def doc_for(self, channel):
+        doc = self.channels.get(channel.id)
+        if doc is not None:
+            return doc
+        guild = getattr(channel, 'guild', None)
+        if guild is not None:
+            doc = self.guilds.get(guild.id)
+        return doc or self.default
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def __len__(self):
+        return len(self.docs)
+
+
 # The error code is gspread.exceptions.APIError
 if __name__ == "__main__":
-    test = DocScanner("https://docs.google.com/spreadsheets/d/1Py0pico9VWu0Nno0nuVFl6kBwZrkmxM8rqlSMWtuGbo/edit#gid=176933786", "test")
+    from backends import GoogleSheetBackend
+    test = DocScanner(GoogleSheetBackend("https://docs.google.com/spreadsheets/d/1Py0pico9VWu0Nno0nuVFl6kBwZrkmxM8rqlSMWtuGbo/edit#gid=176933786", "test"))
     test.remove_user('Reavy')
 
 
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from metrics import registry as metrics
+
+
+class EmbedCache:
+    """Bounded LRU of embeds that have already been built
+
+    Entries are keyed by (roster, member name) and remember the version
+    they were built from, e.g. the member's record and avatar. Member
+    records are replaced whenever the roster changes, so an entry built
+    from an older version is rebuilt rather than sent stale
+
+    Parameters:
+    size: int - Most embeds kept, the least recently used go first.
+        0 turns the cache off
+
+    Methods:
+    --------
+    get(key: tuple, version: tuple):
+        The cached embed for key if it was built from version, else None
+
+    put(key: tuple, version: tuple, embed: discord.Embed):
+        Caches embed, evicting the least recently used if full
+
+    discard(doc, names: iterable):
+        Drops the entries for names on doc's roster, e.g. after a write
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        # [(doc, name)] = (version, embed), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            metrics.inc('embed_cache_total', result='miss')
+            return None
+        self.entries.move_to_end(key)
+        metrics.inc('embed_cache_total', result='hit')
+        return entry[1]
+
+    def put(self, key, version, embed):
+        if not self.size:
+            return
+        self.entries[key] = (version, embed)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, doc, names):
+        for name in names:
+            self.entries.pop((doc, name), None)
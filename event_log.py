@@ -0,0 +1,121 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import json
+import logging
+import queue
+import random
+
+
+class JSONFormatter(logging.Formatter):
+    """One event per line: {"time": ..., "event": ..., fields...}"""
+
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'event': record.msg}
+        entry.update(record.fields)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class ConsoleHandler(logging.Handler):
+    """Prints each event's text line, the way the bot has always logged"""
+
+    def emit(self, record):
+        try:
+            print(record.text)
+        except Exception:
+            self.handleError(record)
+
+
+class EventLog:
+    """Structured log of what the bot does, written off the event loop
+
+    Events are put on a queue by a logging QueueHandler and a
+    QueueListener thread does the printing and file writes, so a slow
+    disk or terminal never holds up a command. With a file open, each
+    event is also written to it as a JSON line, rotated by size
+
+    Parameters:
+    check_sample: float - Fraction of .check commands logged, the rest
+        are dropped before they reach the queue
+
+    Methods:
+    --------
+    open(path: str, max_bytes: int, backups: int):
+        Starts writing events to path as JSON lines, keeping backups old
+        files of up to max_bytes each
+
+    event(name: str, text: str, **fields):
+        Logs an event, printing text and writing fields to the file
+
+    command(command: str, ctx: Context, args: str, outcome: str,
+            seconds: float, sheet_calls: int):
+        Logs a finished command with the fields its handler recorded
+
+    close():
+        Writes out anything still queued and stops the listener
+    """
+
+    def __init__(self, check_sample=1.0):
+        self.check_sample = check_sample
+        self.queue = queue.Queue()
+        self.logger = logging.getLogger('splitbot.events')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(QueueHandler(self.queue))
+        self.handlers = [ConsoleHandler()]
+        self.listener = None
+        self._listen()
+
+    def _listen(self):
+        if self.listener is not None:
+            self.listener.stop()
+        self.listener = QueueListener(self.queue, *self.handlers)
+        self.listener.start()
+
+    def open(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        handler = RotatingFileHandler(
+            path,
+            maxBytes=max_bytes,
+            backupCount=backups,
+            encoding='utf-8'
+        )
+        handler.setFormatter(JSONFormatter())
+        self.handlers.append(handler)
+        # The listener's handlers are fixed once it starts
+        self._listen()
+
+    def event(self, name, text, **fields):
+        self.logger.info(name, extra={'text': text, 'fields': fields})
+
+    def command(self, command, ctx, args, outcome, seconds, sheet_calls):
+        # Lookups far outnumber everything else, so they can be sampled
+        sample = self.check_sample if command == 'check' else 1.0
+        if sample < 1.0 and random.random() >= sample:
+            return
+        fields = {
+            'command': command,
+            'user': str(ctx.author),
+            'user_id': getattr(ctx.author, 'id', None),
+            'guild': getattr(ctx.guild, 'id', None),
+            'channel': getattr(ctx.channel, 'id', None),
+            'outcome': outcome,
+            'latency': round(seconds, 4),
+            'sheet_calls': sheet_calls
+        }
+        fields.update(ctx.event)
+        if sample < 1.0:
+            fields['sample'] = sample
+        text = f'User {ctx.author}: .{command}'
+        if args:
+            text += f' "{args}"'
+        text += f' ({outcome}, {seconds * 1000:.0f}ms, {sheet_calls} sheet calls)'
+        self.event('command', text, **fields)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.close()
+
+
+# Shared by the whole bot
+events = EventLog()
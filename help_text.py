@@ -2,15 +2,25 @@
 
 help_embed = {
     "title": "**Split Bot Commands**", 
-    "desc": 'Please make sure:\nNames match exactly for what you are searching (case sensitive)\nNumbers don\'t have any symbols (no commas or $)\nNates are in the number form MM/DD/YYYY\nItems are comma separated with the proper notation for multiple items (" x2" or " x4" at the end).',
+    "desc": 'Please make sure:\nNames match exactly for what you are updating or removing (case sensitive), .check will find the closest match\nNumbers don\'t have any symbols (no commas or $)\nNates are in the number form MM/DD/YYYY\nItems are comma separated with the proper notation for multiple items (" x2" or " x4" at the end).',
     "n_check": ".check <RSN>",
     "v_check": "Shows stats for the player matching the given RSN.",
     "n_up": ".update <RSN>, <splits>, <items>",
-    "v_up": "Adds the split given to the player with the matching RSN. Items are optional but should be added as a comma separated list at the end. Requires the @ADMIN role.",
+    "v_up": "Adds the split given to the player with the matching RSN. Items are optional but should be added as a comma separated list at the end. To update several players at once, put each one on its own line (e.g. Player: 500000, Sword). Requires the @ADMIN role.",
     "n_add": ".add <RSN>, <splits>, <date>, <items>",
     "v_add": "Creates a new player entry with the given RSN, splits, date, and items. The last three are optional but must be added in that order (so to add a date without adding a split value, use 0. e.g !add Player, 0, 6/12/2019). Requires the @ADMIN role.",
     "n_remove": '.remove <RSN>',
     "v_remove": "Sets the player's manual rank as \"Ex-Member\"",
+    "n_top": ".top <count>",
+    "v_top": "Shows the players with the highest splits, 10 unless a count (up to 25) is given. Ex-Members are left out.",
+    "n_rank": ".rank <RSN>",
+    "v_rank": "Shows where the player stands on the splits leaderboard.",
+    "n_refresh": ".refresh",
+    "v_refresh": "Reloads the roster from the sheet. Use this after editing the sheet by hand. Requires the @ADMIN role.",
+    "n_history": ".history <count>",
+    "v_history": "Lists the last changes made through the bot, 10 unless a count (up to 25) is given. Undone changes are crossed out. Requires the @ADMIN role.",
+    "n_undo": ".undo <count>",
+    "v_undo": "Takes back the last update or remove, or the last few if a count is given. Splits have the change taken back off, items are only put back if they haven't changed since. Adds can't be undone, it stops at the newest one. Requires the @ADMIN role.",
     "footer": "Bot designed by Xaad#1337"
 }
 
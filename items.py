@@ -0,0 +1,87 @@
+import functools
+import re
+
+
+# Trailing count on an item, e.g. "sword x3"
+COUNT_MARK = re.compile(r" x([0-9]+)$")
+# Words left lower case inside item names
+SMALL_WORDS = frozenset(['a', 'an', 'of', 'the', 'is'])
+
+
+@functools.lru_cache(maxsize=4096)
+def proper_case(name):
+    """Properly formats a lower case item name (e.g. Sword of the Cliche)"""
+    words = name.split(' ')
+    formatted = [words[0].title()]
+    for word in words[1:]:
+        formatted.append(word if word in SMALL_WORDS else word.title())
+    return " ".join(formatted)
+
+
+def parse_item(item):
+    """Splits one item into its formatted name and count"""
+    item = item.strip().lower()
+    count_mark = COUNT_MARK.search(item)
+    if count_mark:
+        return proper_case(item[:count_mark.start()]), int(count_mark.group(1))
+    return proper_case(item), 1
+
+
+class ItemInventory:
+    """A member's items as a count per item name
+
+    Names keep the order they were first added in, matching how the item
+    column has always been written. Adding items only parses the new ones,
+    the column text is built when it's needed
+
+    Parameters:
+    items: str - Comma separated item list to start with
+
+    Methods:
+    --------
+    add(items: str):
+        Parses items and adds them to the counts
+
+    merge(other: ItemInventory):
+        Adds another inventory's counts, no parsing needed
+
+    copy():
+        A separate inventory with the same counts
+
+    str(inventory):
+        Formats the list for the sheet (e.g. Sword of the Cliche, Cabbage x4)
+    """
+
+    __slots__ = ('counts',)
+
+    def __init__(self, items=''):
+        self.counts = {}
+        if items:
+            self.add(items)
+
+    def add(self, items):
+        for item in items.split(','):
+            if not item.strip():
+                continue
+            name, count = parse_item(item)
+            self.counts[name] = self.counts.get(name, 0) + count
+        return self
+
+    def merge(self, other):
+        for name, count in other.counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+        return self
+
+    def copy(self):
+        inventory = ItemInventory()
+        inventory.counts = dict(self.counts)
+        return inventory
+
+    def __bool__(self):
+        return bool(self.counts)
+
+    def __str__(self):
+        return ', '.join(
+            name if count == 1 else f'{name} x{count}'
+            for name, count in self.counts.items()
+        )
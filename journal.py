@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+
+
+class Journal:
+    """Append-only file of JSON lines
+
+    Appends are flushed to the OS straight away, so they survive the bot
+    crashing. fsync, which is what makes them survive the machine going
+    down, is slow, so it is batched and run at most every sync_interval
+    seconds from a background thread
+
+    Parameters:
+    path: str - File the entries are appended to
+    sync_interval: float - Seconds between fsyncs, 0 syncs every append
+
+    Methods:
+    --------
+    append(entry: dict):
+        Writes entry as one line
+
+    entries():
+        Every entry in the file, oldest first
+
+    sync():
+        fsyncs anything appended since the last sync
+
+    truncate():
+        Empties the file
+
+    rewrite(entries: iterable):
+        Replaces the file's contents with entries
+
+    close():
+        Syncs and closes the file
+    """
+
+    def __init__(self, path, sync_interval=1.0):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        if sync_interval:
+            self._syncer = threading.Thread(
+                target=self._sync_forever,
+                name='journal-sync',
+                daemon=True
+            )
+            self._syncer.start()
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as journal:
+            for line in journal:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Last line may be cut short if the worker was killed
+                    continue
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.sync_interval:
+                self._dirty = True
+            else:
+                os.fsync(self.file.fileno())
+
+    def sync(self):
+        with self.lock:
+            if not self._dirty or self.file.closed:
+                return
+            self._dirty = False
+            os.fsync(self.file.fileno())
+
+    def _sync_forever(self):
+        while not self._closed.wait(self.sync_interval):
+            self.sync()
+
+    def truncate(self):
+        with self.lock:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._dirty = False
+
+    def rewrite(self, entries):
+        # Written aside and swapped in, so a crash leaves one whole file
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as temp:
+            for entry in entries:
+                temp.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            temp.flush()
+            os.fsync(temp.fileno())
+        with self.lock:
+            self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, 'a')
+            self._dirty = False
+
+    def close(self):
+        self._closed.set()
+        self.sync()
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,76 @@
+from bisect import bisect_left, insort
+import threading
+
+
+class Leaderboard:
+    """Members ordered by splits, highest first
+
+    Kept as a sorted list of (-splits, name) so a member's place is found
+    with a binary search. Changing one member's splits moves only them
+
+    Methods:
+    --------
+    set(name: str, splits: int):
+        Adds name or moves them to their new place
+
+    discard(name: str):
+        Takes name off the board (e.g. Ex-Members)
+
+    top(count: int):
+        The first count members as (name, splits)
+
+    rank(name: str):
+        name's place (1 is highest), or None if they aren't on the board
+    """
+
+    def __init__(self):
+        self.order = []
+        # [name] = splits
+        self.splits = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, name):
+        return name in self.splits
+
+    def set(self, name, splits):
+        with self.lock:
+            current = self.splits.get(name)
+            if current == splits:
+                return
+            if current is not None:
+                del self.order[bisect_left(self.order, (-current, name))]
+            insort(self.order, (-splits, name))
+            self.splits[name] = splits
+
+    def discard(self, name):
+        with self.lock:
+            current = self.splits.pop(name, None)
+            if current is not None:
+                del self.order[bisect_left(self.order, (-current, name))]
+
+    def update(self, members):
+        """Brings the board in line with {name: splits}"""
+        if not self.order:
+            # Sorting once beats inserting one at a time
+            with self.lock:
+                self.splits = dict(members)
+                self.order = sorted((-splits, name) for name, splits in members.items())
+            return
+        for name in [name for name in self.splits if name not in members]:
+            self.discard(name)
+        for name, splits in members.items():
+            self.set(name, splits)
+
+    def top(self, count=10):
+        with self.lock:
+            return [(name, -splits) for splits, name in self.order[:count]]
+
+    def rank(self, name):
+        with self.lock:
+            splits = self.splits.get(name)
+            if splits is None:
+                return None
+            return bisect_left(self.order, (-splits, name)) + 1
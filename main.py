@@ -2,26 +2,70 @@ import discord
 import asyncio
 import json
 import gspread
-import re
+import time
 from datetime import datetime
-from doc_scan import DocScanner
+from concurrent.futures import ThreadPoolExecutor
+from doc_scan import DocScanner, AsyncDocScanner, DocDirectory
+from backends import GoogleClient, GoogleSheetBackend, SQLiteBackend
+from write_behind import WriteBehind
+from change_log import ChangeLog
+from scheduler import SheetScheduler
+from sync import SheetSync
+from metrics import registry as metrics, Trace
+from event_log import events
+from member_index import MemberIndex
+from embed_cache import EmbedCache
 from help_text import help_embed, API_error
+from commands import (
+    CommandRouter, Context, UsageError, 
+    parse_add, parse_count, parse_text, parse_undo, parse_updates
+)
+
+
+router = CommandRouter()
 
 
 class RedemptionBot(discord.Client):
     """Discord client for all Redemption Bot operations"""
 
-    def __init__(self, doc, configs):
+    def __init__(self, docs, configs):
+        """docs is a DocDirectory of AsyncDocScanners, one per roster.
+        Sheet calls are awaited
+        """
         super().__init__()
         self.token = configs['Bot Token']
         self.admin_name = configs['Admin Rank']
-        self.doc = doc
+        self.flush_interval = configs.get('Write Behind', 0)
+        self.sync_interval = configs.get('Sync Interval', 60)
+        self.docs = docs
+        # Seconds before a command is logged as slow, 0 turns it off
+        self.slow_threshold = configs.get('Slow Command Threshold', 0)
+        # Seconds a command waits for its roster to load before giving up
+        self.load_timeout = configs.get('Roster Load Timeout', 60)
+        # Discord members by name, filled in on_ready
+        self.members = MemberIndex()
+        # [guild id] = IDs of roles that count as the admin rank
+        self.admin_roles = {}
+        # .check embeds by member, rebuilt once the member changes
+        self.embeds = EmbedCache(configs.get('Embed Cache Size', 1000))
+        # The help text never changes while the bot is up
+        self.help_message = self.build_help()
         self.start_bot()
 
     def start_bot(self):
         """Connects discord API"""
         loop = asyncio.get_event_loop()
         loop.create_task(self.start(self.token))
+        # Rosters load while the bot logs in, not before
+        for doc in self.docs:
+            loop.create_task(doc.warm_up())
+        for doc in self.docs:
+            # Writes queued .update changes to the sheet every few seconds
+            if self.flush_interval:
+                loop.create_task(doc.flush_forever(self.flush_interval))
+            # Keeps the local SQLite roster and the Google sheet in step
+            if doc.sync is not None and self.sync_interval:
+                loop.create_task(doc.sync_forever(doc.sync, self.sync_interval))
         try:
             loop.run_forever()
         finally:
@@ -34,6 +78,54 @@ class RedemptionBot(discord.Client):
         print('-' * 5)
         game = discord.Game('.splits_help')
         await self.change_presence(activity=game)
+        # Indexes members so avatars are found without scanning the guild
+        for guild in self.guilds:
+            self.members.build(guild)
+
+    async def on_guild_join(self, guild):
+        self.members.build(guild)
+
+    async def on_guild_remove(self, guild):
+        self.members.drop(guild)
+        self.admin_roles.pop(guild.id, None)
+
+    async def on_member_join(self, member):
+        self.members.add(member)
+
+    async def on_member_remove(self, member):
+        self.members.remove(member)
+
+    async def on_member_update(self, before, after):
+        if before.nick != after.nick or before.name != after.name:
+            self.members.update(after)
+
+    async def on_user_update(self, before, after):
+        # Username changes apply to the member in every shared guild
+        if before.name == after.name:
+            return
+        for guild in self.guilds:
+            member = guild.get_member(after.id)
+            if member is not None:
+                self.members.update(member)
+
+    async def on_guild_role_create(self, role):
+        self.admin_roles.pop(role.guild.id, None)
+
+    async def on_guild_role_delete(self, role):
+        self.admin_roles.pop(role.guild.id, None)
+
+    async def on_guild_role_update(self, before, after):
+        self.admin_roles.pop(after.guild.id, None)
+
+    def is_admin(self, author, guild):
+        """Checks author's roles against the cached admin role IDs"""
+        if guild is None:
+            return False
+        admin_ids = self.admin_roles.get(guild.id)
+        if admin_ids is None:
+            admin_ids = {role.id for role in guild.roles if self.admin_name in role.name}
+            self.admin_roles[guild.id] = admin_ids
+        return any(role.id in admin_ids for role in getattr(author, 'roles', ()))
 
     async def on_message(self, message):
         """Bot commands via text inputs"""
@@ -42,222 +134,156 @@ class RedemptionBot(discord.Client):
             return
 
         # Verify command was sent
-        command = re.search(r'^\.[a-z_]+', message.content)
+        command = router.split(message.content)
         if command is None:
             return
-
-        # Prepares basic variables
-        command = command.group()
-        command = command.replace('.', '')
-        msg = message.content.replace(f'.{command}', '').strip()
-        author = message.author
-        channel = message.channel
-        guild = channel.guild
-        isAdmin = str(author.roles).find(self.admin_name) != -1
+        command, msg = command
         
         try:
-            await self.check(command, msg, author, channel, guild, isAdmin)
-
-            # Added 8/2/2019
-            # Delete message if it was .update
-            if command == 'update':
-                await message.delete()
-            
+            await self.check(command, msg, message)
         except gspread.exceptions.APIError:
-            await channel.send(API_error)
-
+            await message.channel.send(API_error)
 
+    async def check(self, command, msg, message):
+        """Runs a command from the router
 
-    async def check(self, command, msg, author, channel, guild, isAdmin):
-        """Commands:
+        Commands:
         .check
         .update
         .add
         .remove
+        .refresh
+        .top
+        .rank
+        .splits_status
         .splits_help
         """
-        if command == 'check':
-            # Request to find information on member
-            print(f'User {author}: Checking for "{msg}"')
-            await channel.trigger_typing()
-            await self.send_user(msg, channel, guild)
-            
-        if command == 'update' and isAdmin:
-            print(f'User {author} updating: "{msg}"')
-            await channel.trigger_typing()
-
-            # Updates user info (!update <name>, <split change>, <items>)
-            inputs = msg.split(',')
-
-            # Name:
-            name = inputs[0].strip()
-            # Delta Values:
-            try: 
-                delta = int(inputs[1])
-            except(ValueError, SyntaxError, TypeError, IndexError):
-                await channel.send("Incorrect format, see .splits_help")
-                return
-            # Gathers items
-            items = ', '.join(inputs[2:]).strip() if len(inputs) > 2 else None
-
-            # Updates sheet
-            updates = self.doc.update_split(name, delta, items)
-            if updates is None:
-                await channel.send(f'Cant find "{name}" on the sheet')
-                return
-            
-
-            # Builds Embed
-            prev_val, new_val, old_items, new_items = updates
-            em_title = f"Splits increased by {delta:,}!"
-            em_desc = f"-----"
-            em_author = f"Updating {name}'s stats"
-            em_url = None
-            em_color = 0x01b0cf
-            em_name_a = "Old Splits"
-            em_val_a = "{:,}".format(prev_val)
-            em_name_b = "New Splits"
-            em_val_b = "{:,}".format(new_val)
-            em_name_c = "Old Items"
-            em_val_c = old_items if old_items is not '' else '-'
-            em_name_d = "New Items"
-            em_val_d = new_items if new_items is not '' else '-'
-
-            player = guild.get_member_named(name)
-            if player is not None:
-                em_url = str(player.avatar_url)
-
-            embed = discord.Embed(
-                title=em_title, 
-                description=em_desc, 
-                color=em_color
-            )
-            if em_url is not None:
-                embed.set_author(name=em_author, icon_url=em_url)
-            else:
-                embed.set_author(name=em_author)
-            embed.add_field(name=em_name_a, value=em_val_a, inline=True)
-            embed.add_field(name=em_name_b, value=em_val_b, inline=True)
-            embed.add_field(name=em_name_c, value=em_val_c, inline=False)
-            embed.add_field(name=em_name_d, value=em_val_d, inline=False)
-
-            await channel.send(embed=embed)
+        entry = router.get(command)
+        if entry is None:
+            return
+        # Each guild or channel can have its own roster
+        doc = self.docs.doc_for(message.channel)
+        if doc is None:
+            return
+        ctx = Context(message, doc)
 
-        if command == 'add' and isAdmin:
-            print(f'User {author} adding: "{msg}"')
-            await channel.trigger_typing()
-
-            # Grabs inputs 
-            inputs = msg.split(',')
-            name = None
-            splits = 0
-            date = None
-            items = []
-
-            for i in range(len(inputs)):
-                if i == 0:
-                    name = inputs[i].strip()
-                    if name == '':
-                        await channel.send('I need a name (see .splits_help)')
-                        return 
-                elif i == 1:
-                    try:
-                        splits = int(inputs[i].strip())
-                    except (ValueError, SyntaxError, TypeError, IndexError):
-                        await channel.send('Incorrect splits format (see .splits_help)')
-                        return
-                elif i == 2:
-                    date_format = r'^[0-1]?[0-9]/[0-3]?[0-9]/20[0-9][0-9]$'
-                    check = re.match(date_format, inputs[i].strip())
-                    if check is None:
-                        await channel.send('Incorrect date format (see .splits_help)')
-                        return 
-                    date = check.group()
+        start = time.perf_counter()
+        outcome = 'ok'
+        spans = Trace()
+        try:
+            with metrics.trace() as spans:
+                # Commands sent during start up wait for the roster
+                if not doc.ready.is_set():
+                    await ctx.channel.trigger_typing()
+                try:
+                    loaded = await doc.wait_ready(self.load_timeout or None)
+                except asyncio.TimeoutError:
+                    # Still retrying, e.g. the API is over quota
+                    outcome = 'timeout'
+                    await ctx.channel.send(API_error)
+                    return
+                if not loaded:
+                    outcome = 'unavailable'
+                    await ctx.channel.send('The roster for this server could not be loaded')
+                # Admin only commands are silently ignored for everyone else
+                elif not entry.admin or self.is_admin(ctx.author, ctx.guild):
                     try:
-                        datetime.strptime(date, r'%m/%d/%Y')
-                    except ValueError:
-                        await channel.send('Incorrect date format (see .splits_help)')
-                        return 
+                        args = entry.parser(msg)
+                    except UsageError as error:
+                        outcome = 'usage'
+                        await ctx.channel.send(str(error))
+                    else:
+                        await entry.handler(self, ctx, *args)
                 else:
-                    items.append(inputs[i])
-            item_list = ', '.join(items)
-
-            # Attempts to add based on provided info
-            results = self.doc.add_user(name, splits, date, item_list)
-
-            if results is None:
-                await channel.send('User already exists!')
-            else:
-                await self.send_user(name, channel, guild)
-
-
-        if command == 'remove':
-            print(f'User {author} removing: "{msg}"')
-            await channel.trigger_typing()
-
-            result = self.doc.remove_user(msg)
-
-            if result is None:
-                await channel.send(f'Cant find "{msg}" on the sheet')
-            else:
-                await channel.send(f'Player {msg} marked as Ex-Member')
-
+                    outcome = 'denied'
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.inc('commands_total', command=command, outcome=outcome)
+            metrics.observe('command_seconds', elapsed, command=command)
+            if self.slow_threshold and elapsed >= self.slow_threshold:
+                self.log_slow(command, ctx, elapsed, spans)
+            events.command(
+                command, ctx, msg, outcome, elapsed, 
+                spans.counts.get('sheet_call_seconds', 0)
+            )
 
-        if command == 'splits_status':
-            await channel.send('Bot Active')
+        # Added 8/2/2019
+        # Delete message if it was .update
+        if entry.delete:
+            await message.delete()
+
+    def log_slow(self, command, ctx, elapsed, spans):
+        # Shows where the time went, whatever isn't listed was spent
+        # waiting on discord or in the event loop
+        timed = sum(spans.values())
+        parts = ', '.join(
+            f'{span} {seconds:.3f}s' 
+            for span, seconds in sorted(spans.items(), key=lambda span: -span[1])
+        )
+        events.event(
+            'slow_command',
+            f'Slow command .{command} from {ctx.author}: {elapsed:.3f}s '
+            f'({parts + ", " if parts else ""}other {max(elapsed - timed, 0):.3f}s)',
+            command=command,
+            user=str(ctx.author),
+            latency=round(elapsed, 4),
+            spans={span: round(seconds, 4) for span, seconds in spans.items()}
+        )
 
-        if command == 'splits_help':
-            await channel.trigger_typing()
-            # Sends help text
-            em = help_embed
-            emb = discord.Embed(
-                title=em['title'], 
-                description=em['desc'], 
-                color=0x01b0cf
-            )
-            v_up = em['v_up'].replace('@ADMIN', self.admin_name)
-            v_add = em['v_add'].replace('@ADMIN', self.admin_name)
-            emb.add_field(name=em['n_check'], value=em['v_check'], inline=False)
-            emb.add_field(name=em['n_up'], value=v_up, inline=False)
-            emb.add_field(name=em['n_add'], value=v_add, inline=False)
-            emb.add_field(name=em['n_remove'], value=em['v_remove'], inline=False)
-            emb.set_footer(text=em['footer'])
-            await channel.send(embed=emb)
-
-
-    async def send_user(self, name, channel, guild):
-        # Send embed with splits info
-
-        values = self.doc.get_split(name)
-        if values is None:
-            await channel.send(f'Can\'t find someone named "{name}"')
+    @router.command('check', parse_text)
+    async def check_command(self, ctx, name):
+        # Request to find information on member
+        ctx.event['query'] = name
+        await ctx.channel.trigger_typing()
+        ctx.event['member'] = await self.send_user(ctx.doc, name, ctx.channel, ctx.guild)
+
+    @router.command('update', parse_updates, admin=True, delete=True)
+    async def update_command(self, ctx, updates, bulk):
+        channel = ctx.channel
+        await channel.trigger_typing()
+
+        if bulk:
+            ctx.event['member'] = [update[0] for update in updates]
+            ctx.event['delta'] = [update[1] for update in updates]
+            await self.bulk_update(ctx.doc, updates, channel, ctx.message.id)
             return
 
-        # Prepares display values
-        splits = values[1]
-        items = values[2]
-        days = values[3]
-        rank = values[4]
-        avatar = None
-
-        player = guild.get_member_named(name)
-        if player is not None:
-            avatar = str(player.avatar_url)
+        # Updates user info (!update <name>, <split change>, <items>)
+        name, delta, items = updates[0]
+        ctx.event['member'] = name
+        ctx.event['delta'] = delta
+
+        # Updates sheet
+        # Tagged with the message ID so a retry can't apply it twice
+        updates = await ctx.doc.update_split(name, delta, items, ctx.message.id)
+        self.embeds.discard(ctx.doc, [name])
+        if updates is None:
+            await self.send_not_found(ctx.doc, f'Cant find "{name}" on the sheet', name, channel)
+            return
         
-        # Build embed
-        em_title = "Split Value:"
-        em_desc = "{:,}".format(splits)
+
+        # Builds Embed
+        prev_val, new_val, old_items, new_items = updates
+        em_title = f"Splits increased by {delta:,}!"
+        em_desc = f"-----"
+        em_author = f"Updating {name}'s stats"
+        em_url = None
         em_color = 0x01b0cf
-        em_author = f"{name}'s stats:"
-        em_url = avatar
-        em_name_a = "Current Rank: "
-        em_value_a = f'{rank}'
-        em_name_b = "Days in Clan: "
-        em_value_b = f'{days} days'
-        # 8/2/2019 Update: added items to display
-        if items:
-            em_name_c = "Items: "
-            em_value_c = items
+        em_name_a = "Old Splits"
+        em_val_a = "{:,}".format(prev_val)
+        em_name_b = "New Splits"
+        em_val_b = "{:,}".format(new_val)
+        em_name_c = "Old Items"
+        em_val_c = old_items if old_items is not '' else '-'
+        em_name_d = "New Items"
+        em_val_d = new_items if new_items is not '' else '-'
+
+        player = self.members.get(ctx.guild, name)
+        if player is not None:
+            em_url = str(player.avatar_url)
 
         embed = discord.Embed(
             title=em_title, 
@@ -268,15 +294,378 @@ class RedemptionBot(discord.Client):
             embed.set_author(name=em_author, icon_url=em_url)
         else:
             embed.set_author(name=em_author)
-        embed.add_field(name=em_name_a, value=em_value_a, inline=False)
-        embed.add_field(name=em_name_b, value=em_value_b, inline=False)
-        if items:
-            embed.add_field(name=em_name_c, value=em_value_c, inline=False)
+        embed.add_field(name=em_name_a, value=em_val_a, inline=True)
+        embed.add_field(name=em_name_b, value=em_val_b, inline=True)
+        embed.add_field(name=em_name_c, value=em_val_c, inline=False)
+        embed.add_field(name=em_name_d, value=em_val_d, inline=False)
+
+        await channel.send(embed=embed)
+
+    @router.command('add', parse_add, admin=True)
+    async def add_command(self, ctx, name, splits, date, item_list):
+        ctx.event['member'] = name
+        ctx.event['delta'] = splits
+        await ctx.channel.trigger_typing()
+
+        # Attempts to add based on provided info
+        results = await ctx.doc.add_user(name, splits, date, item_list, ctx.message.id)
+        self.embeds.discard(ctx.doc, [name])
+
+        if results is None:
+            await ctx.channel.send('User already exists!')
+        else:
+            await self.send_user(ctx.doc, name, ctx.channel, ctx.guild)
+
+    @router.command('remove', parse_text)
+    async def remove_command(self, ctx, name):
+        ctx.event['member'] = name
+        await ctx.channel.trigger_typing()
+
+        result = await ctx.doc.remove_user(name, ctx.message.id)
+        self.embeds.discard(ctx.doc, [name])
+
+        if result is None:
+            await self.send_not_found(ctx.doc, f'Cant find "{name}" on the sheet', name, ctx.channel)
+        else:
+            await ctx.channel.send(f'Player {name} marked as Ex-Member')
+
+    @router.command('refresh', admin=True)
+    async def refresh_command(self, ctx):
+        await ctx.channel.trigger_typing()
+
+        # Drops the cached roster and reloads it from the sheet
+        count, changed = await ctx.doc.refresh()
+        ctx.event['members'] = count
+        ctx.event['changed'] = len(changed)
+        await ctx.channel.send(
+            f'Roster reloaded from the sheet ({count:,} members, {len(changed):,} changed)'
+        )
 
+    @router.command('top', parse_count)
+    async def top_command(self, ctx, count):
+        ctx.event['count'] = count
+        await ctx.channel.trigger_typing()
+
+        leaders = await ctx.doc.top_splits(count)
+        lines = [
+            f'{place}. {name} - {splits:,}' 
+            for place, (name, splits) in enumerate(leaders, 1)
+        ]
+        embed = discord.Embed(
+            title=f"Top {len(leaders)} Splits", 
+            description='\n'.join(lines) or '-', 
+            color=0x01b0cf
+        )
+        await ctx.channel.send(embed=embed)
+
+    @router.command('rank', parse_text)
+    async def rank_command(self, ctx, msg):
+        ctx.event['query'] = msg
+        channel = ctx.channel
+        await channel.trigger_typing()
+
+        # Forgives case and small spelling errors like .check
+        name = await ctx.doc.find_member(msg)
+        ctx.event['member'] = name
+        if name is None:
+            await self.send_not_found(ctx.doc, f'Can\'t find someone named "{msg}"', msg, channel)
+            return
+        ranked = await ctx.doc.rank_of(name)
+        if ranked is None:
+            await channel.send(f'{name} isn\'t on the leaderboard')
+            return
+        place, total, splits = ranked
+        await channel.send(f'{name} is #{place:,} of {total:,} with {splits:,} splits')
+
+    @router.command('history', parse_count, admin=True)
+    async def history_command(self, ctx, count):
+        ctx.event['count'] = count
+        await ctx.channel.trigger_typing()
+
+        entries = await ctx.doc.history(count)
+        lines = [describe_change(entry) for entry in entries]
+        embed = discord.Embed(
+            title=f"Last {len(entries)} Changes", 
+            description='\n'.join(lines) or '-', 
+            color=0x01b0cf
+        )
+        await ctx.channel.send(embed=embed)
+
+    @router.command('undo', parse_undo, admin=True)
+    async def undo_command(self, ctx, count):
+        ctx.event['count'] = count
+        await ctx.channel.trigger_typing()
+
+        entries, stopped = await ctx.doc.undo(count, ctx.message.id)
+        ctx.event['undone'] = len(entries)
+        self.embeds.discard(
+            ctx.doc, [result[0] for entry in entries for result in entry['results']]
+        )
+        # Adds can't be undone, older changes are left alone
+        note = None
+        if stopped is not None:
+            ctx.event['stopped'] = stopped['op']
+            note = f'Stopped at adding {stopped["results"][0][0]}, adds have to be removed by hand'
+        if not entries:
+            await ctx.channel.send(note or 'Nothing to undo')
+            return
+        lines = [describe_change(entry) for entry in entries]
+        if note is not None:
+            lines.append(note)
+        embed = discord.Embed(
+            title=f"Undid {len(entries)} Changes", 
+            description='\n'.join(lines), 
+            color=0x01b0cf
+        )
+        await ctx.channel.send(embed=embed)
+
+    @router.command('splits_status')
+    async def status_command(self, ctx):
+        # Reports how busy the sheets API queue is
+        stats = ctx.doc.sheet_stats()
+        if not stats:
+            await ctx.channel.send('Bot Active')
+            return
+        await ctx.channel.send(
+            'Bot Active\n'
+            f'Sheets queue: {stats["queued"]} waiting, '
+            f'{stats["avg_wait"]:.2f}s average wait '
+            f'({stats["max_wait"]:.2f}s max), '
+            f'{stats["retries"]} retries, {stats["failures"]} failed calls'
+        )
+
+    @router.command('splits_help')
+    async def help_command(self, ctx):
+        await ctx.channel.trigger_typing()
+        # Sends help text
+        await ctx.channel.send(embed=self.help_message)
+
+    def build_help(self):
+        em = help_embed
+        emb = discord.Embed(
+            title=em['title'], 
+            description=em['desc'], 
+            color=0x01b0cf
+        )
+        v_up = em['v_up'].replace('@ADMIN', self.admin_name)
+        v_add = em['v_add'].replace('@ADMIN', self.admin_name)
+        emb.add_field(name=em['n_check'], value=em['v_check'], inline=False)
+        emb.add_field(name=em['n_up'], value=v_up, inline=False)
+        emb.add_field(name=em['n_add'], value=v_add, inline=False)
+        emb.add_field(name=em['n_remove'], value=em['v_remove'], inline=False)
+        emb.add_field(name=em['n_top'], value=em['v_top'], inline=False)
+        emb.add_field(name=em['n_rank'], value=em['v_rank'], inline=False)
+        v_refresh = em['v_refresh'].replace('@ADMIN', self.admin_name)
+        emb.add_field(name=em['n_refresh'], value=v_refresh, inline=False)
+        v_history = em['v_history'].replace('@ADMIN', self.admin_name)
+        emb.add_field(name=em['n_history'], value=v_history, inline=False)
+        v_undo = em['v_undo'].replace('@ADMIN', self.admin_name)
+        emb.add_field(name=em['n_undo'], value=v_undo, inline=False)
+        emb.set_footer(text=em['footer'])
+        return emb
+
+    async def bulk_update(self, doc, updates, channel, op_id):
+        # Applies an update per line in a single sheet write
+        results, missing = await doc.update_splits(updates, op_id)
+        self.embeds.discard(doc, [update[0] for update in updates])
+        if missing:
+            names = ', '.join(f'"{name}"' for name in missing)
+            await channel.send(f'Nothing was updated, cant find {names} on the sheet')
+            return
+
+        # One summary embed for everyone
+        embed = discord.Embed(
+            title=f"Splits updated for {len(results)} members!", 
+            description="-----", 
+            color=0x01b0cf
+        )
+        for (name, prev_val, new_val, _, new_items), update in zip(results, updates):
+            value = f"{prev_val:,} -> {new_val:,} ({update[1]:+,})"
+            if new_items:
+                value += f"\nItems: {new_items}"
+            embed.add_field(name=name, value=value, inline=False)
         await channel.send(embed=embed)
 
+    async def send_not_found(self, doc, text, name, channel):
+        # Adds "did you mean" suggestions to a name not found message
+        suggestions = await doc.suggest_names(name)
+        if suggestions:
+            text += '. Did you mean: ' + ', '.join(suggestions) + '?'
+        await channel.send(text)
+
+    async def send_user(self, doc, name, channel, guild):
+        # Send embed with splits info, returns the roster name it matched
+
+        # Forgives case and small spelling errors
+        match = await doc.find_member(name)
+        if match is None:
+            await self.send_not_found(doc, f'Can\'t find someone named "{name}"', name, channel)
+            return None
+        name = match
+        values = await doc.get_split(name)
+        avatar = None
+
+        player = self.members.get(guild, name)
+        if player is not None:
+            avatar = str(player.avatar_url)
 
+        # Popular members are looked up again and again between updates
+        key = (doc, name)
+        version = (values, avatar)
+        embed = self.embeds.get(key, version)
+        if embed is None:
+            embed = user_embed(name, values, avatar)
+            self.embeds.put(key, version, embed)
+
+        with metrics.timer('discord_seconds', call='send'):
+            await channel.send(embed=embed)
+        return name
+
+
+    
+def user_embed(name, values, avatar):
+    """Builds the .check embed for a member's roster record"""
+    # Prepares display values
+    splits = values.splits
+    items = values.items
+    days = values.days
+    rank = values.rank
     
+    # Build embed
+    em_title = "Split Value:"
+    em_desc = "{:,}".format(splits)
+    em_color = 0x01b0cf
+    em_author = f"{name}'s stats:"
+    em_url = avatar
+    em_name_a = "Current Rank: "
+    em_value_a = f'{rank}'
+    em_name_b = "Days in Clan: "
+    em_value_b = f'{days} days'
+    # 8/2/2019 Update: added items to display
+    if items:
+        em_name_c = "Items: "
+        em_value_c = items
+
+    embed = discord.Embed(
+        title=em_title, 
+        description=em_desc, 
+        color=em_color
+    )
+    if em_url is not None:
+        embed.set_author(name=em_author, icon_url=em_url)
+    else:
+        embed.set_author(name=em_author)
+    embed.add_field(name=em_name_a, value=em_value_a, inline=False)
+    embed.add_field(name=em_name_b, value=em_value_b, inline=False)
+    if items:
+        embed.add_field(name=em_name_c, value=em_value_c, inline=False)
+    return embed
+
+
+def describe_change(entry):
+    """One line summary of a change log entry for .history and .undo"""
+    when = datetime.fromtimestamp(entry['time']).strftime('%m/%d %H:%M')
+    kind = entry['kind']
+    if kind == 'update':
+        changes = ', '.join(
+            f'{name} {new_val - prev_val:+,}' + (' (items)' if new_items is not None else '')
+            for name, prev_val, new_val, _, new_items in entry['results']
+        )
+    elif kind == 'undo':
+        changes = f'{len(entry["results"])} changes'
+    else:
+        changes = entry['results'][0][0]
+    line = f'{when} {kind} {changes}'
+    if entry.get('undone_by'):
+        line = f'~~{line}~~'
+    return line
+
+
+def open_backend(roster, client):
+    """Picks where the roster is stored from the "Storage" setting"""
+    storage = roster.get("Storage", "sheets")
+    if storage == "sqlite":
+        path = roster.get("SQLite Path", "roster.db")
+        print(f'Loading SQLite roster {path}...')
+        return SQLiteBackend(path)
+
+    print(f'Loading Google sheet {roster["Worksheet Name"]}...')
+    return open_sheet(roster, client)
+
+
+def open_sheet(roster, client):
+    return GoogleSheetBackend(
+        roster["Spreadsheet URL"], 
+        roster["Worksheet Name"], 
+        client=client
+    )
+
+
+def open_roster(configs, roster, client, executor):
+    """Builds the scanner for one roster
+    roster holds that roster's settings, for the default roster it's
+    the top level configs
+    """
+    # Queues .update changes locally if write-behind is turned on
+    write_behind = None
+    if configs.get("Write Behind"):
+        journal = roster.get("Write Behind Journal", "pending_updates.jsonl")
+        write_behind = WriteBehind(journal, configs.get("Journal Sync Interval", 1))
+
+    # Every change is journaled so retries can't apply it twice and
+    # .undo can take it back
+    changes = ChangeLog(
+        roster.get("Change Journal", "changes.jsonl"),
+        sync_interval=configs.get("Journal Sync Interval", 1)
+    )
+
+    # The sheet is opened and read by warm_up, alongside the discord login
+    sync = None
+    doc = DocScanner(
+        open_backend(roster, client), 
+        cache_ttl=configs.get("Cache TTL", 60),
+        write_behind=write_behind,
+        changes=changes,
+        connect=False
+    )
+
+    # A SQLite roster mirrors the Google sheet. The local file opens
+    # straight away, the sheet is connected and synced by sync_forever
+    # once the local roster has loaded
+    if isinstance(doc.backend, SQLiteBackend):
+        doc.connect_to_API()
+        if configs.get("Sync Interval", 60):
+            sync = SheetSync(
+                doc.backend, open_sheet(roster, client), 
+                lock=doc.lock, invalidate=doc.invalidate
+            )
+
+    # Sheet calls run on their own threads so they don't block discord
+    return AsyncDocScanner(doc, executor=executor, sync=sync)
+
+
+def roster_configs(configs):
+    """Lists (roster settings, guild ID, channel ID) for every roster
+
+    The top level "Spreadsheet URL" is the default roster. Entries in
+    "Sheets" give a guild or channel its own roster, their journal and
+    SQLite files are named after the ID unless set
+    """
+    rosters = []
+    if "Spreadsheet URL" in configs:
+        rosters.append((configs, None, None))
+    for entry in configs.get("Sheets", []):
+        guild = entry.get("Guild")
+        channel = entry.get("Channel")
+        key = channel if channel is not None else guild
+        roster = dict(entry)
+        roster.setdefault("Change Journal", f"changes-{key}.jsonl")
+        roster.setdefault("Write Behind Journal", f"pending_updates-{key}.jsonl")
+        roster.setdefault("SQLite Path", f"roster-{key}.db")
+        rosters.append((roster, guild, channel))
+    return rosters
+
+
 def start():
     print("Initiating...")
     try:
@@ -288,30 +677,78 @@ def start():
         return
 
     # Verifies configs
-    reqs = ("Bot Token", "Admin Rank", "Spreadsheet URL", "Worksheet Name")
-    if not all(req in configs for req in reqs):
+    reqs = ("Bot Token", "Admin Rank")
+    sheet_reqs = ("Spreadsheet URL", "Worksheet Name")
+    rosters = roster_configs(configs)
+    valid = all(req in configs for req in reqs) and rosters and all(
+        all(req in roster for req in sheet_reqs) 
+        and (roster is configs or guild is not None or channel is not None)
+        for roster, guild, channel in rosters
+    )
+    if not valid:
         print('ERROR: Configs not formatting correctly, please consult the Readme')
         return
 
-    # Opens document
-    print('Loading Google sheet...')
+    # Every roster shares the credentials, the HTTP session, the sheets
+    # quota and the worker threads
+    executor = ThreadPoolExecutor(
+        max_workers=configs.get("Sheet Workers", 4), 
+        thread_name_prefix='sheets'
+    )
+    docs = DocDirectory()
+    client = None
     try:
-        doc = DocScanner(configs["Spreadsheet URL"], configs["Worksheet Name"])
-        print("Document loaded correctly")
-    except(gspread.exceptions.NoValidUrlKeyFound): 
-        print("ERROR: Document could not be loaded from the URL")
-        invalid_input()
-    except(gspread.exceptions.WorksheetNotFound):
-        print("ERROR: Document could not find worksheet " + worksheet)
-        invalid_input()
+        needs_google = configs.get("Sync Interval", 60) or any(
+            roster.get("Storage", "sheets") != "sqlite" for roster, _, _ in rosters
+        )
+        if needs_google:
+            client = GoogleClient(
+                scheduler=SheetScheduler(per_minute=configs.get("Sheets Quota", 60))
+            )
+        for roster, guild, channel in rosters:
+            docs.add(open_roster(configs, roster, client, executor), guild, channel)
     except(FileNotFoundError):
         print("ERROR: Credentials file not found, please consult Readme")
+        return
+
+    # Commands are logged as JSON lines for looking back at traffic
+    events.check_sample = configs.get("Check Log Sample", 1.0)
+    if configs.get("Event Log", "events.jsonl"):
+        events.open(
+            configs.get("Event Log", "events.jsonl"),
+            max_bytes=configs.get("Event Log Size", 10) * 1024 * 1024,
+            backups=configs.get("Event Log Backups", 5)
+        )
+
+    # Serves command and sheet call metrics for Prometheus to scrape
+    if configs.get("Metrics Port"):
+        metrics.gauge('leaderboard_members', lambda: sum(len(doc.doc.leaderboard) for doc in docs))
+        if client is not None:
+            stats = client.scheduler.stats
+            metrics.gauge('sheet_queue_depth', lambda: stats()['queued'])
+            metrics.gauge('sheet_retries', lambda: stats()['retries'])
+        metrics.serve(configs["Metrics Port"])
 
     # Loads bot API
     print('Loading discord bot...')
-    redemption_bot = RedemptionBot(doc, configs)
+    redemption_bot = RedemptionBot(docs, configs)
     
-    # Shuts down
+    # Shuts down, writing anything still queued
+    for async_doc in docs:
+        doc = async_doc.doc
+        try:
+            # A roster that never loaded has nothing new to write
+            if async_doc.ready.is_set() and async_doc.error is None:
+                doc.flush()
+                if async_doc.sync is not None:
+                    async_doc.sync.sync()
+        except gspread.exceptions.APIError:
+            print("ERROR: Pending updates could not be written, they will be retried on the next start")
+        doc.changes.close()
+        if doc.write_behind is not None:
+            doc.write_behind.close()
+    executor.shutdown(wait=True)
+    events.close()
     print('Bot successfully shut down')
     print('Good bye')
     
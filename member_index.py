@@ -0,0 +1,111 @@
+import threading
+
+
+class GuildMembers:
+    """One guild's members by their case folded name and nickname"""
+
+    def __init__(self, members=()):
+        # [folded name] = {member id: member}
+        self.names = {}
+        # [member id] = folded names the member is filed under
+        self.keys = {}
+        for member in members:
+            self.add(member)
+
+    def add(self, member):
+        keys = {name.casefold() for name in (member.name, member.nick) if name}
+        for key in keys:
+            self.names.setdefault(key, {})[member.id] = member
+        self.keys[member.id] = keys
+
+    def remove(self, member):
+        # Uses the names it was filed under, member may already be renamed
+        for key in self.keys.pop(member.id, ()):
+            members = self.names.get(key)
+            if members is None:
+                continue
+            members.pop(member.id, None)
+            if not members:
+                del self.names[key]
+
+    def get(self, name):
+        members = self.names.get(name.casefold())
+        if not members:
+            return None
+        # An exact nickname or name beats a match that only differs by case
+        for member in members.values():
+            if member.nick == name or member.name == name:
+                return member
+        return next(iter(members.values()))
+
+
+class MemberIndex:
+    """Discord members by name and nickname, kept per guild
+
+    Replaces guild.get_member_named, which checks every member in the
+    guild, with a dict lookup. Roster names are matched against Discord
+    names and nicknames ignoring case
+
+    Methods:
+    --------
+    build(guild: discord.Guild):
+        (Re)indexes every member of guild
+
+    drop(guild: discord.Guild):
+        Forgets a guild the bot has left
+
+    add(member: discord.Member):
+        Indexes a member who joined
+
+    remove(member: discord.Member):
+        Forgets a member who left
+
+    update(member: discord.Member):
+        Re-files a member after a name or nickname change
+
+    get(guild: discord.Guild, name: str):
+        The member called name in guild, or None
+    """
+
+    def __init__(self):
+        # [guild id] = GuildMembers
+        self.guilds = {}
+        self.lock = threading.Lock()
+
+    def build(self, guild):
+        members = GuildMembers(guild.members)
+        with self.lock:
+            self.guilds[guild.id] = members
+
+    def drop(self, guild):
+        with self.lock:
+            self.guilds.pop(guild.id, None)
+
+    def add(self, member):
+        with self.lock:
+            members = self.guilds.get(member.guild.id)
+            if members is not None:
+                members.add(member)
+
+    def remove(self, member):
+        with self.lock:
+            members = self.guilds.get(member.guild.id)
+            if members is not None:
+                members.remove(member)
+
+    def update(self, member):
+        with self.lock:
+            members = self.guilds.get(member.guild.id)
+            if members is not None:
+                members.remove(member)
+                members.add(member)
+
+    def get(self, guild, name):
+        if guild is None:
+            return None
+        with self.lock:
+            members = self.guilds.get(guild.id)
+            if members is not None:
+                return members.get(name)
+        # Not indexed yet (e.g. before on_ready), falls back to a scan
+        return guild.get_member_named(name)
@@ -0,0 +1,202 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left
+import contextlib
+import contextvars
+import threading
+import time
+
+
+# Upper bounds in seconds, from a cached lookup up to a stalled sheet call
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Spans timed while handling the current command, see Metrics.trace
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Trace(dict):
+    """Seconds spent per span while handling one command, as
+    {label: seconds}, with counts holding {metric name: observations}
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.counts = {}
+
+
+class Metrics:
+    """Counters and latency histograms, served in Prometheus text format
+
+    Metrics are keyed by name and a sorted tuple of label pairs, so e.g.
+    every command gets its own series under splitbot_command_seconds
+
+    Methods:
+    --------
+    inc(name: str, amount: int, **labels):
+        Adds amount to a counter
+
+    observe(name: str, seconds: float, **labels):
+        Records a duration in a histogram, and in the current trace
+
+    timer(name: str, **labels):
+        Context manager that observes how long its block took
+
+    gauge(name: str, func):
+        Registers func, returning a number, to be read on every scrape
+
+    trace():
+        Context manager that collects the spans timed inside it as a
+        Trace, used for the slow command log and the event log
+
+    render():
+        All metrics as Prometheus text
+
+    serve(port: int, host: str):
+        Serves render() at /metrics on a background thread
+    """
+
+    def __init__(self, prefix='splitbot'):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+        # Sheet calls run on worker threads, AsyncDocScanner copies the
+        # command's context over so they land in the same trace
+        spans = _trace.get()
+        if spans is not None:
+            span = '.'.join(str(value) for value in labels.values()) or name
+            spans[span] = spans.get(span, 0) + seconds
+            spans.counts[name] = spans.counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    @contextlib.contextmanager
+    def trace(self):
+        spans = Trace()
+        token = _trace.set(spans)
+        try:
+            yield spans
+        finally:
+            _trace.reset(token)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.total, h.count))
+                for key, h in self.histograms.items()
+            )
+
+        typed = set()
+        for (name, labels), value in counters:
+            name = f'{self.prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+
+        for (name, labels), (counts, total, count) in histograms:
+            name = f'{self.prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            running = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), counts):
+                running += bucket
+                le = labels + (('le', bound),)
+                lines.append(f'{name}_bucket{_labels(le)} {running}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                # A broken gauge shouldn't take the whole page down
+                continue
+            name = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would drown out the bot's output
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        print(f'Serving metrics on http://{host}:{port}/metrics')
+        return server
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Shared by the bot, the scanner and the backends
+registry = Metrics()
@@ -0,0 +1,158 @@
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from itertools import chain, islice
+import threading
+
+
+class NameIndex:
+    """Typo tolerant lookup over roster names
+
+    Names are case folded and broken into trigrams. A search only scores
+    the names that share a trigram with the query, counting the rarest
+    trigrams first and stopping after scan_limit entries. Trigrams most
+    names share (e.g. a clan tag, or "Player" in Player1..Player50000)
+    say little about which name was meant, so lookups don't slow down
+    as the roster grows
+
+    Parameters:
+    names: iterable - Names to start the index with
+
+    Methods:
+    --------
+    update(names: iterable):
+        Brings the index in line with names, only touching the difference
+
+    add(name: str) / discard(name: str):
+        Adds or removes a single name
+
+    best(query: str, cutoff: float):
+        Closest name scoring at least cutoff, or None
+
+    suggest(query: str, limit: int, cutoff: float):
+        Up to limit close names, best first
+    """
+
+    # Most trigram posting entries counted per search
+    scan_limit = 2000
+
+    def __init__(self, names=()):
+        # [folded name] = original names, several if they only differ by case
+        self.names = {}
+        # [trigram] = set of folded names
+        self.grams = defaultdict(set)
+        self.lock = threading.Lock()
+        self.update(names)
+
+    def __len__(self):
+        return sum(len(originals) for originals in self.names.values())
+
+    def __contains__(self, name):
+        return name.casefold() in self.names
+
+    @staticmethod
+    def _trigrams(folded):
+        # Padding weights the start of the name, where typos are rarer
+        padded = f'  {folded} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, name):
+        with self.lock:
+            folded = name.casefold()
+            originals = self.names.setdefault(folded, set())
+            originals.add(name)
+            if len(originals) > 1:
+                # Already indexed under the same folded name
+                return
+            for gram in self._trigrams(folded):
+                self.grams[gram].add(folded)
+
+    def discard(self, name):
+        with self.lock:
+            folded = name.casefold()
+            originals = self.names.get(folded)
+            if not originals or name not in originals:
+                return
+            originals.discard(name)
+            if originals:
+                # Another name differing only by case still uses the trigrams
+                return
+            del self.names[folded]
+            for gram in self._trigrams(folded):
+                posting = self.grams[gram]
+                posting.discard(folded)
+                if not posting:
+                    del self.grams[gram]
+
+    def update(self, names):
+        """Adds new names and drops missing ones"""
+        names = set(names)
+        current = set(chain.from_iterable(self.names.values()))
+        for name in current - names:
+            self.discard(name)
+        for name in names - current:
+            self.add(name)
+
+    def exact(self, query):
+        """Case insensitive exact match, or None
+        An exact case match wins over names that only differ by case
+        """
+        with self.lock:
+            originals = self.names.get(query.casefold())
+            if not originals:
+                return None
+            if query in originals:
+                return query
+            return min(originals)
+
+    def suggest(self, query, limit=3, cutoff=0.4):
+        """Returns up to limit names similar to query, best first"""
+        folded = query.strip().casefold()
+        if not folded:
+            return []
+        grams = self._trigrams(folded)
+
+        with self.lock:
+            # Counts shared trigrams, rarest first, until scan_limit
+            # entries have been counted
+            postings = sorted(
+                (self.grams[gram] for gram in grams if gram in self.grams), 
+                key=len
+            )
+            shared = Counter()
+            budget = self.scan_limit
+            for posting in postings:
+                if len(posting) > budget and shared:
+                    break
+                shared.update(islice(posting, budget))
+                budget -= len(posting)
+            candidates = [
+                (candidate, sorted(self.names.get(candidate, ())))
+                for candidate, _ in shared.most_common(max(limit * 5, 20))
+            ]
+
+        # Re-ranks the short list on full string similarity
+        scored = []
+        floor = cutoff
+        for candidate, originals in candidates:
+            matcher = SequenceMatcher(None, folded, candidate)
+            # Cheap upper bounds first, most candidates stop here
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            score = matcher.ratio()
+            if score < floor:
+                continue
+            scored.extend((score, name) for name in originals)
+            if len(scored) >= limit:
+                # Nothing scoring below the current top limit can make it
+                scored.sort(key=lambda pair: -pair[0])
+                floor = max(floor, scored[limit - 1][0])
+        scored.sort(key=lambda pair: -pair[0])
+        return [name for _, name in scored[:limit]]
+
+    def best(self, query, cutoff=0.75):
+        """Returns the closest name if it is close enough, else None"""
+        match = self.exact(query)
+        if match is not None:
+            return match
+        found = self.suggest(query, limit=1, cutoff=cutoff)
+        return found[0] if found else None
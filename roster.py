@@ -0,0 +1,109 @@
+# Columns the roster is read from: A name, B splits, C items, E rank,
+# G days and H manual rank. D (date) and F are never needed
+COLUMNS = (1, 2, 3, 5, 7, 8)
+
+
+class Member:
+    """One member's row on the roster
+
+    Records are treated as read only, replace() makes an updated copy so
+    the cached roster is only changed once a write has gone through
+
+    Parameters:
+    row: int - Sheet row the member is on
+    splits: int - Split value
+    items: str - Item column text
+    days: str - Days in the clan
+    rank: str - Rank shown on the sheet
+    manual_rank: str - Rank set by hand (e.g. Ex-Member)
+    """
+
+    __slots__ = ('row', 'splits', 'items', 'days', 'rank', 'manual_rank')
+
+    def __init__(self, row, splits, items='', days='', rank='', manual_rank=''):
+        self.row = row
+        self.splits = splits
+        self.items = items
+        self.days = days
+        self.rank = rank
+        self.manual_rank = manual_rank
+
+    def replace(self, **changes):
+        return Member(**{
+            slot: changes.get(slot, getattr(self, slot)) for slot in self.__slots__
+        })
+
+    def __eq__(self, other):
+        if not isinstance(other, Member):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    @property
+    def ex_member(self):
+        return self.manual_rank == "Ex-Member"
+
+    def __repr__(self):
+        return 'Member(%s)' % ', '.join(
+            f'{slot}={getattr(self, slot)!r}' for slot in self.__slots__
+        )
+
+
+def parse_member(row, name, split, items, rank, days, manual_rank):
+    """Turns one row's cells into (name, Member)
+    Returns None for blank names or splits that aren't a proper integer
+    """
+    if not name:
+        return None
+    try:
+        amount = int(split.replace(",", "").replace("$", ""))
+    except (ValueError, AttributeError):
+        return None
+    return name, Member(row, amount, items, days, rank, manual_rank)
+
+
+def load_roster(columns, previous=None):
+    """Builds {name: Member} from the COLUMNS as read by get_columns
+
+    previous is the row table from an earlier load. Rows whose cells hash
+    the same as last time reuse that load's Member instead of parsing it
+    again. Returns (roster, row table), the row table holding
+    {row: (hash, name, Member)} for the next load
+    """
+    previous = previous or {}
+    names, splits, items, ranks, days, manual_ranks = columns
+    roster = {}
+    rows = {}
+    for i, name in enumerate(names):
+        row = i + 1
+        cells = (
+            name, _cell(splits, i), _cell(items, i), _cell(ranks, i),
+            _cell(days, i), _cell(manual_ranks, i)
+        )
+        row_hash = hash(cells)
+        last = previous.get(row)
+        if last is not None and last[0] == row_hash:
+            parsed = last[1:]
+        else:
+            # Rows that aren't members (headers, blanks) are kept as None
+            parsed = parse_member(row, *cells) or (None, None)
+        rows[row] = (row_hash,) + parsed
+        if parsed[0] is not None:
+            roster[parsed[0]] = parsed[1]
+    return roster, rows
+
+
+def diff_roster(old, new):
+    """Names added, removed or changed between two rosters"""
+    changed = set()
+    for name, member in new.items():
+        last = old.get(name)
+        # Unchanged rows are usually the very same record
+        if last is not member and last != member:
+            changed.add(name)
+    changed.update(name for name in old if name not in new)
+    return changed
+
+
+def _cell(column, i):
+    # API responses drop trailing empty cells
+    return column[i] if i < len(column) else ''
@@ -0,0 +1,123 @@
+import gspread
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class SheetScheduler:
+    """Gatekeeper for every Google Sheets API call
+
+    Calls take a token from a bucket sized to the per-minute quota, so a
+    burst of commands queues up instead of tripping the quota. Writes are
+    let through before waiting reads. Calls that fail with a quota or
+    server error are retried with exponential backoff and jitter
+
+    Parameters:
+    per_minute: int - Requests allowed per minute (the Sheets quota)
+    max_retries: int - Retries before an error is passed on
+    base_delay: float - Seconds to back off after the first failure
+    max_delay: float - Longest single back off in seconds
+
+    Methods:
+    --------
+    call(func, *args, write: bool, **kwargs):
+        Waits for a token then runs func, retrying on busy errors
+
+    stats():
+        Returns queue depth, wait times and retry counts as a dictionary
+    """
+
+    WRITE = 0
+    READ = 1
+
+    # Quota exceeded and temporary server errors are worth retrying
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, per_minute=60, max_retries=4, base_delay=1.0,
+                 max_delay=32.0):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # Callers waiting for a token, ordered by (priority, arrival)
+        self.waiting = []
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+
+        # Reporting
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=READ):
+        """Blocks until the caller is first in line and a token is free"""
+        start = time.monotonic()
+        with self.cond:
+            ticket = (priority, next(self.order))
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                self._refill()
+                first = self.waiting[0] == ticket
+                if first and self.tokens >= 1:
+                    break
+                # Only the first in line needs to wake up for the refill,
+                # everyone else is woken when the line moves
+                timeout = (1 - self.tokens) / self.rate if first else None
+                self.cond.wait(timeout)
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.cond.notify_all()
+
+            waited = time.monotonic() - start
+            self.calls += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def call(self, func, *args, write=False, **kwargs):
+        """Runs func(*args, **kwargs) inside the quota"""
+        priority = self.WRITE if write else self.READ
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as error:
+                if attempt == self.max_retries or not self._retryable(error):
+                    self.failures += 1
+                    raise
+                # Full jitter keeps retrying threads from lining back up
+                ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = random.uniform(0, ceiling)
+                self.retries += 1
+                print(f'Sheets API busy, retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def _retryable(self, error):
+        response = getattr(error, 'response', None)
+        return getattr(response, 'status_code', None) in self.RETRY_STATUS
+
+    def stats(self):
+        """Current queue depth and wait times"""
+        with self.cond:
+            average = self.total_wait / self.calls if self.calls else 0.0
+            return {
+                'queued': len(self.waiting),
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'avg_wait': average,
+                'max_wait': self.max_wait
+            }
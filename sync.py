@@ -0,0 +1,227 @@
+import gspread
+import json
+import threading
+
+
+class SheetSync:
+    """Two-way sync between the local SQLite roster and the Google sheet
+
+    Members are matched by name (column A), not row, so sorting the sheet
+    or adding rows on either side doesn't mix members up. Each pass
+    compares both sides against the values agreed on at the end of the
+    last pass (the base), cell by cell:
+    - Changed only locally (bot commands): pushed to the sheet
+    - Changed only on the sheet (officer edits): pulled into SQLite
+    - Changed on both: splits keep both changes (sheet value plus the
+      local delta), any other column takes the sheet's value
+
+    A name only on one side is new and is appended to the other side.
+    A name that was synced before but has gone from the sheet (deleted or
+    renamed by hand) is cleared from SQLite too
+
+    Rank (E) and column F belong to the sheet, so they are only ever
+    pulled. Days (G) is left out, SQLite works it out from the join date
+
+    Parameters:
+    local: SQLiteBackend - The bot's primary roster store
+    remote: GoogleSheetBackend - The clan's Google sheet
+    lock: threading.RLock - Held while touching local rows, so bot writes
+        don't land between the sync reading and writing SQLite
+    invalidate: callable - Called under lock once pulled cells are in
+        SQLite, so the roster cache drops the values they replaced
+
+    Methods:
+    --------
+    sync():
+        Runs one sync pass, returns the set of local rows that changed
+    """
+
+    # Columns the bot writes, everything else belongs to the sheet
+    TWO_WAY = (1, 2, 3, 4, 8)
+    SPLITS = 2
+    DAYS = 7
+    WIDTH = 8
+
+    def __init__(self, local, remote, lock=None, invalidate=None):
+        self.local = local
+        self.remote = remote
+        self.lock = lock or threading.RLock()
+        self.invalidate = invalidate
+        # The sheet is opened by the first pass, so the local roster
+        # doesn't wait on it
+        self.connected = False
+        with self.local.lock, self.local.db:
+            self.local.db.execute(
+                'CREATE TABLE IF NOT EXISTS sync_members (name TEXT PRIMARY KEY, cells TEXT)'
+            )
+
+    def _remote(self, method, *args, **kwargs):
+        """Calls the sheet, reconnecting once on an API error, e.g. when
+        the access token has expired
+        """
+        if not self.connected:
+            self.remote.connect()
+            self.connected = True
+        try:
+            return getattr(self.remote, method)(*args, **kwargs)
+        except gspread.exceptions.APIError:
+            print("API Error while syncing, attempting reconnect")
+            self.remote.connect()
+            return getattr(self.remote, method)(*args, **kwargs)
+
+    def _load_base(self):
+        with self.local.lock:
+            records = self.local.db.execute('SELECT name, cells FROM sync_members').fetchall()
+        return {name: json.loads(cells) for name, cells in records}
+
+    def _save_base(self, base, names, dropped=()):
+        with self.local.lock, self.local.db:
+            self.local.db.executemany(
+                'INSERT OR REPLACE INTO sync_members VALUES (?, ?)',
+                [(name, json.dumps(base[name])) for name in names]
+            )
+            self.local.db.executemany(
+                'DELETE FROM sync_members WHERE name = ?',
+                [(name,) for name in dropped]
+            )
+
+    @staticmethod
+    def _amount(value):
+        try:
+            return int(value.replace(",", "").replace("$", ""))
+        except ValueError:
+            return None
+
+    def _same(self, col, a, b):
+        # The sheet shows 1,000 where SQLite holds 1000
+        if col == self.SPLITS and a != b:
+            return self._amount(a) is not None and self._amount(a) == self._amount(b)
+        return a == b
+
+    def _merge(self, name, col, local, remote, base):
+        """Returns the value both sides should end up with"""
+        if col == self.SPLITS:
+            amounts = [self._amount(v) for v in (local, remote, base)]
+            if None not in amounts:
+                return str(amounts[1] + amounts[0] - amounts[2])
+        print(f'Sync conflict for {name} column {col}: '
+              f'kept sheet value "{remote}" over "{local}"')
+        return remote
+
+    def sync(self):
+        """Runs one sync pass"""
+        # The slow sheet read happens before taking the lock
+        remote_rows = self._remote('get_all_values')
+
+        with self.lock:
+            local_rows = self.local.get_all_values()
+            base = self._load_base()
+            local_index = self._index(local_rows)
+            remote_index = self._index(remote_rows)
+            # New members go below the last name on each side
+            next_local = self._next_row(local_rows)
+            next_remote = self._next_row(remote_rows)
+            pulls = {}
+            pushes = {}
+            moved = set()
+            pushed = set()
+            dropped = []
+
+            names = list(local_index)
+            names += [name for name in remote_index if name not in local_index]
+            names += [name for name in base if name not in local_index and name not in remote_index]
+            for name in names:
+                local_row = local_index.get(name)
+                remote_row = remote_index.get(name)
+                agreed = base.get(name)
+
+                if remote_row is None and agreed is not None:
+                    # Deleted or renamed on the sheet since the last pass
+                    if local_row is not None:
+                        local = self._row(local_rows, local_row)
+                        if any(not self._same(col, local[col - 1], agreed[col - 1]) 
+                               for col in self.TWO_WAY):
+                            print(f'Sync conflict for {name}: removed from the sheet, '
+                                  f'dropping the bot\'s changes')
+                        for col in range(1, self.WIDTH + 1):
+                            if col != self.DAYS and local[col - 1]:
+                                pulls[(local_row, col)] = ''
+                    dropped.append(name)
+                    continue
+
+                # A name new to one side is appended to the other
+                if remote_row is None:
+                    remote_row = next_remote
+                    next_remote += 1
+                if local_row is None:
+                    local_row = next_local
+                    next_local += 1
+                    # Nothing local to merge, the sheet's values are pulled
+                    agreed = None
+
+                local = self._row(local_rows, local_row)
+                remote = self._row(remote_rows, remote_row)
+                agreed = list(agreed or [''] * self.WIDTH)
+                before = list(agreed)
+                for col in range(1, self.WIDTH + 1):
+                    if col == self.DAYS:
+                        continue
+                    l, r, b = local[col - 1], remote[col - 1], agreed[col - 1]
+                    if col not in self.TWO_WAY or self._same(col, l, b):
+                        value = r
+                    elif self._same(col, r, b) or self._same(col, l, r):
+                        value = l
+                    else:
+                        value = self._merge(name, col, l, r, b)
+
+                    if not self._same(col, value, l):
+                        pulls[(local_row, col)] = value
+                    if not self._same(col, value, r):
+                        pushes[(remote_row, col)] = value
+                        pushed.add(name)
+                    agreed[col - 1] = value
+                if agreed != before or name not in base:
+                    base[name] = agreed
+                    moved.add(name)
+
+            if pulls:
+                self.local.update_cells(pulls)
+                # Drops cached values the pulls replaced before a bot
+                # write can be worked out from them
+                if self.invalidate is not None:
+                    self.invalidate()
+
+            # Pushed cells only join the base once the sheet has them,
+            # so a failed push is retried on the next pass
+            self._save_base(base, moved - pushed, dropped)
+
+        if pushes:
+            self._remote('update_cells', pushes)
+            self._save_base(base, pushed)
+            print(f'Sync pushed {len(pushes)} cells to the sheet')
+        if pulls:
+            print(f'Sync pulled {len(pulls)} cells from the sheet')
+
+        return {row for row, _ in pulls}
+
+    @staticmethod
+    def _index(rows):
+        """[name] = row for every named row, the first one if repeated"""
+        index = {}
+        for i, values in enumerate(rows):
+            name = values[0] if values else ''
+            if name and name not in index:
+                index[name] = i + 1
+        return index
+
+    @staticmethod
+    def _next_row(rows):
+        last = 0
+        for i, values in enumerate(rows):
+            if values and values[0]:
+                last = i + 1
+        return last + 1
+
+    def _row(self, rows, row):
+        values = rows[row - 1] if row <= len(rows) else []
+        return list(values) + [''] * (self.WIDTH - len(values))
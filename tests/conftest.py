@@ -0,0 +1,92 @@
+import os
+import sys
+
+import gspread
+import pytest
+
+# The bot's modules live at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backends import MemoryBackend
+from change_log import ChangeLog
+
+
+HEADER = ['RSN', 'Splits', 'Items', 'Join Date', 'Rank', '', 'Days', 'Manual Rank']
+
+
+def member(name, splits, items='', manual_rank=''):
+    """One sheet row for a member who joined on 1/1/2019"""
+    return [name, str(splits), items, '1/1/2019', 'Member', '', '300', manual_rank]
+
+
+def names(backend):
+    return [row[0] for row in backend.get_all_values() if row[0]]
+
+
+def row_of(backend, name):
+    for row in backend.get_all_values():
+        if row[0] == name:
+            return row
+    return None
+
+
+def splits_of(backend, name):
+    row = row_of(backend, name)
+    return int(row[1].replace(',', '')) if row is not None else None
+
+
+def sort_sheet(backend):
+    """Sorts the members Z to A, like an officer sorting the sheet by hand"""
+    rows = backend.get_all_values()
+    backend.load_rows(rows[:1] + sorted(rows[1:], key=lambda row: row[0], reverse=True))
+
+
+class ErrorResponse:
+    """requests response for an API call that failed"""
+
+    def __init__(self, status_code=429, text='Quota exceeded'):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return {}
+
+
+class FlakySheet(MemoryBackend):
+    """MemoryBackend whose next few writes fail with an API error"""
+
+    def __init__(self, rows):
+        super().__init__(rows)
+        self.failures = 0
+
+    def update_cells(self, cells, echo=False):
+        if self.failures:
+            self.failures -= 1
+            raise gspread.exceptions.APIError(ErrorResponse())
+        return super().update_cells(cells, echo)
+
+
+
+class NoNetwork(MemoryBackend):
+    """Backend whose first few connects fail like a DNS error at boot"""
+
+    def __init__(self, rows, failures):
+        super().__init__(rows)
+        self.failures = failures
+
+    def connect(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('Name or service not known')
+
+
+@pytest.fixture
+def sheet():
+    return FlakySheet([HEADER, member('Alice', 100), member('Bob', 200)])
+
+
+@pytest.fixture
+def changes(tmp_path):
+    log = ChangeLog(str(tmp_path / 'changes.jsonl'), sync_interval=0)
+    yield log
+    log.close()
@@ -0,0 +1,267 @@
+import asyncio
+
+import gspread
+import pytest
+
+from backends import MemoryBackend
+from conftest import HEADER, FlakySheet, NoNetwork, member, row_of, sort_sheet, splits_of
+from doc_scan import AsyncDocScanner, DocScanner
+from write_behind import WriteBehind
+
+
+def test_undo_retried_after_failed_write_reverts_once(sheet, changes):
+    doc = DocScanner(sheet, changes=changes)
+    doc.update_split('Alice', 50, op_id=1)
+    assert splits_of(sheet, 'Alice') == 150
+
+    # Both tries inside write_cells fail, undo's own retry gets through
+    sheet.failures = 2
+    undone, stopped = doc.undo(1, op_id=2)
+
+    assert [entry['op'] for entry in undone] == ['1']
+    assert stopped is None
+    assert splits_of(sheet, 'Alice') == 100
+    assert changes.get(1)['undone_by'] == '2'
+    assert changes.get(2)['done']
+    assert doc.get_split('Alice').splits == 100
+
+    # Running the same undo again changes nothing
+    doc.undo(1, op_id=2)
+    assert splits_of(sheet, 'Alice') == 100
+
+
+def test_update_starts_from_hand_edit_made_since_the_roster_was_cached(sheet):
+    doc = DocScanner(sheet, cache_ttl=60)
+    assert doc.get_split('Alice').splits == 100
+    # An officer fixes Alice's split by hand within the cache TTL
+    sheet.update_cells({(2, 2): '5000'})
+
+    prev_val, new_val, _, _ = doc.update_split('Alice', 10)
+
+    assert (prev_val, new_val) == (5000, 5010)
+    assert splits_of(sheet, 'Alice') == 5010
+    assert doc.get_split('Alice').splits == 5010
+
+
+def test_update_finds_member_after_sheet_is_sorted(sheet):
+    doc = DocScanner(sheet, cache_ttl=60)
+    doc.get_all_splits()
+    sort_sheet(sheet)
+
+    results, missing = doc.update_splits([('Alice', 10, None), ('Bob', 1, None)])
+
+    assert missing == []
+    assert splits_of(sheet, 'Alice') == 110
+    assert splits_of(sheet, 'Bob') == 201
+
+
+
+def test_undo_reverts_the_right_member_after_sheet_is_sorted(sheet, changes):
+    doc = DocScanner(sheet, cache_ttl=60, changes=changes)
+    doc.update_split('Alice', 50, op_id=1)
+    sort_sheet(sheet)
+
+    undone, stopped = doc.undo(1, op_id=2)
+
+    assert [entry['op'] for entry in undone] == ['1']
+    assert splits_of(sheet, 'Alice') == 100
+    assert splits_of(sheet, 'Bob') == 200
+
+
+def test_undo_of_remove_restores_the_right_member_after_sheet_is_sorted(changes):
+    sheet = FlakySheet([HEADER, member('Alice', 100), member('Bob', 200, manual_rank='Officer')])
+    doc = DocScanner(sheet, cache_ttl=60, changes=changes)
+    doc.remove_user('Alice', op_id=1)
+    sort_sheet(sheet)
+
+    doc.undo(1, op_id=2)
+
+    assert row_of(sheet, 'Alice')[7] == ''
+    assert row_of(sheet, 'Bob')[7] == 'Officer'
+
+
+def test_retried_update_goes_to_the_right_member_after_sheet_is_sorted(sheet, changes):
+    doc = DocScanner(sheet, cache_ttl=60, changes=changes)
+    # Fails through both reconnect retries, the op is journaled but not done
+    sheet.failures = 4
+    with pytest.raises(gspread.exceptions.APIError):
+        doc.update_split('Alice', 50, op_id=1)
+    sort_sheet(sheet)
+
+    assert doc.update_split('Alice', 50, op_id=1) == (100, 150, None, None)
+
+    assert splits_of(sheet, 'Alice') == 150
+    assert splits_of(sheet, 'Bob') == 200
+
+
+def test_retried_undo_goes_to_the_right_member_after_sheet_is_sorted(sheet, changes):
+    doc = DocScanner(sheet, cache_ttl=60, changes=changes)
+    doc.update_split('Alice', 50, op_id=1)
+    sheet.failures = 4
+    with pytest.raises(gspread.exceptions.APIError):
+        doc.undo(1, op_id=2)
+    sort_sheet(sheet)
+
+    undone, _ = doc.undo(1, op_id=2)
+
+    assert [entry['op'] for entry in undone] == ['1']
+    assert splits_of(sheet, 'Alice') == 100
+    assert splits_of(sheet, 'Bob') == 200
+
+
+def test_undo_stops_at_an_add(sheet, changes):
+    doc = DocScanner(sheet, changes=changes)
+    doc.update_split('Alice', 50, op_id=1)
+    doc.add_user('Carol', 10, op_id=2)
+
+    undone, stopped = doc.undo(1, op_id=3)
+
+    assert undone == []
+    assert stopped['op'] == '2'
+    assert splits_of(sheet, 'Alice') == 150
+
+    # Newer changes are undone, the add and anything older are left
+    doc.update_split('Bob', 5, op_id=4)
+    undone, stopped = doc.undo(3, op_id=5)
+
+    assert [entry['op'] for entry in undone] == ['4']
+    assert stopped['op'] == '2'
+    assert splits_of(sheet, 'Bob') == 200
+    assert splits_of(sheet, 'Alice') == 150
+    assert splits_of(sheet, 'Carol') == 10
+
+def warm_up(backend):
+    async def run():
+        doc = AsyncDocScanner(DocScanner(backend, connect=False))
+        await doc.warm_up(retry_delay=0, max_failures=3)
+        ready = await doc.wait_ready(timeout=1)
+        doc.shutdown()
+        return doc, ready
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_warm_up_retries_connection_errors(sheet):
+    doc, ready = warm_up(NoNetwork(sheet.get_all_values(), failures=2))
+    assert ready
+    assert doc.error is None
+
+
+def test_warm_up_reports_errors_that_keep_coming_and_keeps_retrying(sheet):
+    backend = NoNetwork(sheet.get_all_values(), failures=5)
+
+    async def run():
+        doc = AsyncDocScanner(DocScanner(backend, connect=False))
+        task = asyncio.ensure_future(doc.warm_up(retry_delay=0.05, max_failures=3))
+        # Commands are told the roster is unavailable after 3 failures
+        assert not await doc.wait_ready(timeout=1)
+        assert isinstance(doc.error, ConnectionError)
+
+        # and can use it once the network is back
+        await asyncio.wait_for(doc.loaded.wait(), 1)
+        assert await doc.wait_ready(timeout=1)
+        assert doc.error is None
+        await task
+        doc.shutdown()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_wait_ready_times_out_while_still_loading():
+    async def run():
+        doc = AsyncDocScanner(DocScanner(MemoryBackend(), connect=False))
+        with pytest.raises(asyncio.TimeoutError):
+            await doc.wait_ready(timeout=0.01)
+        doc.shutdown()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_flush_interrupted_after_writing_is_not_applied_twice(sheet, tmp_path):
+    path = str(tmp_path / 'pending.jsonl')
+    queue = WriteBehind(path, sync_interval=0)
+    doc = DocScanner(sheet, write_behind=queue)
+    doc.update_split('Alice', 50)
+
+    # The worker dies after the write, before the journal is cleared
+    def die():
+        raise SystemExit
+    queue.clear = die
+    with pytest.raises(SystemExit):
+        doc.flush()
+    assert splits_of(sheet, 'Alice') == 150
+    queue.journal.close()
+
+    queue = WriteBehind(path, sync_interval=0)
+    assert queue.pending == {}
+    doc = DocScanner(sheet, write_behind=queue)
+    doc.warm_up()
+    doc.flush()
+    assert splits_of(sheet, 'Alice') == 150
+    assert queue.flushing == {}
+    queue.close()
+
+
+def test_flush_interrupted_before_writing_is_finished_on_restart(sheet, tmp_path):
+    path = str(tmp_path / 'pending.jsonl')
+    queue = WriteBehind(path, sync_interval=0)
+    doc = DocScanner(sheet, write_behind=queue)
+    doc.update_split('Alice', 50)
+    sheet.failures = 2
+    with pytest.raises(gspread.exceptions.APIError):
+        doc.flush()
+    # Queued after the failed flush, kept as a delta
+    doc.update_split('Bob', 5)
+    queue.journal.close()
+
+    queue = WriteBehind(path, sync_interval=0)
+    doc = DocScanner(sheet, write_behind=queue)
+    assert doc.warm_up() == 2
+    assert splits_of(sheet, 'Alice') == 150
+    assert splits_of(sheet, 'Bob') == 205
+    doc.flush()
+    assert splits_of(sheet, 'Alice') == 150
+    assert splits_of(sheet, 'Bob') == 205
+    queue.close()
+
+
+def test_remove_marks_the_right_member_after_sheet_is_sorted(sheet):
+    doc = DocScanner(sheet, cache_ttl=60)
+    doc.get_all_splits()
+    sort_sheet(sheet)
+
+    assert doc.remove_user('Alice')
+
+    assert row_of(sheet, 'Alice')[7] == 'Ex-Member'
+    assert row_of(sheet, 'Bob')[7] == ''
+
+
+def test_flush_forever_keeps_going_after_other_errors(sheet, tmp_path):
+    queue = WriteBehind(str(tmp_path / 'pending.jsonl'), sync_interval=0)
+    doc = DocScanner(sheet, write_behind=queue)
+    doc.update_split('Alice', 50)
+    write_cells = doc.write_cells
+    calls = []
+
+    def drop_first(cells, echo=False):
+        calls.append(cells)
+        if len(calls) == 1:
+            raise ConnectionError('Connection reset by peer')
+        return write_cells(cells, echo)
+
+    doc.write_cells = drop_first
+
+    async def run():
+        facade = AsyncDocScanner(doc)
+        facade.ready.set()
+        facade.loaded.set()
+        task = asyncio.ensure_future(facade.flush_forever(0.01))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if splits_of(sheet, 'Alice') == 150:
+                break
+        task.cancel()
+        facade.shutdown()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert len(calls) >= 2
+    assert splits_of(sheet, 'Alice') == 150
+    queue.close()
@@ -0,0 +1,35 @@
+from name_index import NameIndex
+
+
+def test_names_differing_only_by_case_are_both_kept():
+    index = NameIndex(['Woox', 'WOOX', 'Zezima'])
+
+    assert len(index) == 3
+    assert index.exact('WOOX') == 'WOOX'
+    assert index.exact('Woox') == 'Woox'
+
+    index.discard('WOOX')
+    assert 'woox' in index
+    assert index.exact('woox') == 'Woox'
+    assert index.best('Wox') == 'Woox'
+
+    index.discard('Woox')
+    assert 'woox' not in index
+    assert index.best('Wox') is None
+
+
+def test_update_only_touches_the_difference():
+    index = NameIndex(['Woox', 'WOOX'])
+    index.update(['Woox', 'Zezima'])
+
+    assert index.exact('WOOX') == 'Woox'
+    assert index.exact('zezima') == 'Zezima'
+    assert len(index) == 2
+
+
+def test_typo_found_among_names_sharing_a_prefix():
+    index = NameIndex([f'Player{i}' for i in range(20000)] + ['RP Zezima', 'RP Woox'])
+
+    assert index.best('Player1234x') == 'Player1234'
+    assert index.best('RP Zezma') == 'RP Zezima'
+    assert index.suggest('rp wox', limit=1) == ['RP Woox']
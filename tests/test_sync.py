@@ -0,0 +1,242 @@
+import asyncio
+
+import gspread
+import pytest
+
+from backends import MemoryBackend, SQLiteBackend
+from conftest import HEADER, ErrorResponse, NoNetwork, member, names, splits_of
+from doc_scan import AsyncDocScanner, DocScanner
+from sync import SheetSync
+
+
+@pytest.fixture
+def synced(tmp_path):
+    """A SQLite roster and a sheet that agree after one pass"""
+    rows = [HEADER, member('Alice', 100), member('Bob', 200)]
+    local = SQLiteBackend(str(tmp_path / 'roster.db'))
+    local.load_rows(rows)
+    remote = MemoryBackend(rows)
+    sync = SheetSync(local, remote)
+    sync.sync()
+    return local, remote, sync
+
+
+def test_first_pass_changes_nothing(synced):
+    local, remote, sync = synced
+    assert sync.sync() == set()
+    assert names(local) == names(remote) == ['RSN', 'Alice', 'Bob']
+
+
+def test_local_change_follows_member_after_sheet_is_sorted(synced):
+    local, remote, sync = synced
+    # The bot adds 50 to Alice, then an officer sorts the sheet
+    local.update_cells({(2, 2): 150})
+    remote.load_rows([HEADER, member('Bob', 200), member('Alice', 100)])
+
+    sync.sync()
+
+    assert splits_of(remote, 'Alice') == 150
+    assert splits_of(remote, 'Bob') == 200
+    assert splits_of(local, 'Alice') == 150
+    assert splits_of(local, 'Bob') == 200
+
+
+def test_sheet_change_follows_member_after_sheet_is_sorted(synced):
+    local, remote, sync = synced
+    remote.load_rows([HEADER, member('Bob', 200), member('Alice', 900)])
+
+    sync.sync()
+
+    assert splits_of(local, 'Alice') == 900
+    assert splits_of(local, 'Bob') == 200
+
+
+def test_split_deltas_on_both_sides_are_kept(synced):
+    local, remote, sync = synced
+    local.update_cells({(2, 2): 150})
+    remote.update_cells({(2, 2): '130'})
+
+    sync.sync()
+
+    assert splits_of(local, 'Alice') == 180
+    assert splits_of(remote, 'Alice') == 180
+    # Agreed values don't move again on the next pass
+    assert sync.sync() == set()
+    assert splits_of(remote, 'Alice') == 180
+
+
+def test_split_deltas_on_both_sides_after_sort(synced):
+    local, remote, sync = synced
+    local.update_cells({(3, 2): 260})
+    remote.load_rows([HEADER, member('Bob', 210), member('Alice', 100)])
+
+    sync.sync()
+
+    assert splits_of(local, 'Bob') == 270
+    assert splits_of(remote, 'Bob') == 270
+    assert splits_of(remote, 'Alice') == 100
+
+
+def test_concurrent_appends_keep_both_members(synced):
+    local, remote, sync = synced
+    # The bot adds Carol while an officer adds Dave in the same new row
+    local.update_cells({(4, 1): 'Carol', (4, 2): 5, (4, 4): '2/2/2020'})
+    remote.update_cells({(4, 1): 'Dave', (4, 2): '7', (4, 4): '3/3/2020'})
+
+    sync.sync()
+
+    assert sorted(names(local)) == sorted(names(remote)) == ['Alice', 'Bob', 'Carol', 'Dave', 'RSN']
+    assert splits_of(remote, 'Carol') == 5
+    assert splits_of(local, 'Dave') == 7
+    assert splits_of(local, 'Carol') == 5
+    assert splits_of(remote, 'Dave') == 7
+    assert sync.sync() == set()
+
+
+def test_member_removed_from_sheet_is_cleared_locally(synced):
+    local, remote, sync = synced
+    remote.load_rows([HEADER, member('Bob', 200)])
+
+    sync.sync()
+
+    assert names(local) == ['RSN', 'Bob']
+    # Not added back to the sheet on later passes
+    sync.sync()
+    assert names(remote) == ['RSN', 'Bob']
+
+
+def test_failed_push_is_retried(synced):
+    local, remote, sync = synced
+    local.update_cells({(2, 2): 150})
+    update_cells = remote.update_cells
+
+    def fail(cells, echo=False):
+        raise ConnectionError('sheet unavailable')
+
+    remote.update_cells = fail
+    with pytest.raises(ConnectionError):
+        sync.sync()
+    remote.update_cells = update_cells
+
+    sync.sync()
+    assert splits_of(remote, 'Alice') == 150
+    assert splits_of(local, 'Alice') == 150
+
+
+def test_cache_is_invalidated_under_the_lock_when_cells_are_pulled(tmp_path):
+    rows = [HEADER, member('Alice', 100)]
+    local = SQLiteBackend(str(tmp_path / 'roster.db'))
+    local.load_rows(rows)
+    remote = MemoryBackend(rows)
+    held = []
+
+    class Lock:
+        locked = False
+
+        def __enter__(self):
+            Lock.locked = True
+
+        def __exit__(self, *exc):
+            Lock.locked = False
+
+    sync = SheetSync(local, remote, lock=Lock(), invalidate=lambda: held.append(Lock.locked))
+    sync.sync()
+    assert held == []
+
+    remote.update_cells({(2, 2): '500'})
+    sync.sync()
+    assert held == [True]
+
+
+class ExpiringSheet(MemoryBackend):
+    """MemoryBackend whose token runs out, like gspread's after an hour"""
+
+    expired = False
+
+    def connect(self):
+        self.expired = False
+
+    def get_all_values(self):
+        if self.expired:
+            raise gspread.exceptions.APIError(
+                ErrorResponse(401, 'Request had invalid authentication credentials')
+            )
+        return super().get_all_values()
+
+
+def test_expired_token_reconnects_and_syncs(tmp_path):
+    rows = [HEADER, member('Alice', 100)]
+    local = SQLiteBackend(str(tmp_path / 'roster.db'))
+    local.load_rows(rows)
+    remote = ExpiringSheet(rows)
+    sync = SheetSync(local, remote)
+    sync.sync()
+
+    remote.expired = True
+    remote.update_cells({(2, 2): '500'})
+    sync.sync()
+
+    assert not remote.expired
+    assert splits_of(local, 'Alice') == 500
+
+
+def test_sync_forever_keeps_going_after_connection_errors(synced):
+    local, remote, sync = synced
+    passes = []
+    run_sync = sync.sync
+
+    def drop_first():
+        passes.append(1)
+        if len(passes) == 1:
+            raise ConnectionError('Connection reset by peer')
+        return run_sync()
+
+    sync.sync = drop_first
+    remote.update_cells({(2, 2): '500'})
+
+    async def run():
+        doc = AsyncDocScanner(DocScanner(local))
+        doc.ready.set()
+        doc.loaded.set()
+        task = asyncio.ensure_future(doc.sync_forever(sync, 0.01))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if splits_of(local, 'Alice') == 500:
+                break
+        task.cancel()
+        doc.shutdown()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert len(passes) >= 2
+    assert splits_of(local, 'Alice') == 500
+
+
+def test_local_roster_loads_while_the_sheet_is_unreachable(tmp_path):
+    rows = [HEADER, member('Alice', 100), member('Bob', 200)]
+    local = SQLiteBackend(str(tmp_path / 'roster.db'))
+    local.load_rows(rows)
+    remote = NoNetwork(rows, failures=1000)
+    scanner = DocScanner(local)
+    sync = SheetSync(local, remote, lock=scanner.lock, invalidate=scanner.invalidate)
+
+    async def run():
+        doc = AsyncDocScanner(scanner, sync=sync)
+        await doc.warm_up(retry_delay=0, max_failures=3)
+        assert await doc.wait_ready(timeout=1)
+        assert (await doc.get_split('Alice')).splits == 100
+
+        # Syncing starts once the sheet can be reached
+        task = asyncio.ensure_future(doc.sync_forever(sync, 0.01))
+        await asyncio.sleep(0.05)
+        remote.failures = 0
+        remote.update_cells({(2, 2): '500'})
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if (await doc.get_split('Alice')).splits == 500:
+                break
+        task.cancel()
+        doc.shutdown()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert splits_of(local, 'Alice') == 500
+    assert scanner.get_split('Alice').splits == 500
@@ -0,0 +1,100 @@
+from items import ItemInventory
+from journal import Journal
+
+
+class WriteBehind:
+    """Holds .update changes that haven't been written to the sheet yet
+
+    Changes for the same member are merged together, so a burst of updates
+    turns into one row write per member when flushed. Every change is also
+    appended to a journal file which is replayed on start up, so nothing
+    pending is lost if the worker restarts before a flush
+
+    A flush journals the absolute cells it is about to write before
+    writing them. If the worker stops before the journal is cleared, the
+    replay finds those cells in flushing instead of the deltas they
+    cover, so the flush is finished by writing them again rather than
+    adding the deltas a second time
+
+    Parameters:
+    journal_path: str - File the pending changes are appended to
+    sync_interval: float - Seconds between fsyncs of the journal
+
+    Methods:
+    --------
+    add(name: str, delta: int, items: str):
+        Queues a change and merges it with anything pending for name
+
+    apply(name: str, splits: int, items: str):
+        Returns (splits, items) with name's pending change added on top
+
+    begin_flush(cells: dict):
+        Journals the cells a flush is about to write
+
+    clear():
+        Forgets everything pending once it has been written to the sheet
+    """
+
+    def __init__(self, journal_path, sync_interval=1.0):
+        self.journal = Journal(journal_path, sync_interval)
+        # [name] = [delta, ItemInventory or None]
+        self.pending = {}
+        # {(row, col): value} from a flush that didn't finish
+        self.flushing = {}
+        self._replay()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _replay(self):
+        """Loads changes left in the journal by a previous run"""
+        for entry in self.journal.entries():
+            if 'flush' in entry:
+                # Everything queued so far is in the flush's cells
+                self.pending = {}
+                self.flushing.update(
+                    ((row, col), value) for row, col, value in entry['flush']
+                )
+                continue
+            self._merge(entry['name'], entry['delta'], entry['items'])
+        if self.flushing:
+            print(f'Replayed an unfinished flush of {len(self.flushing)} cells')
+        if self.pending:
+            print(f'Replayed pending updates for {len(self.pending)} members')
+
+    def _merge(self, name, delta, items):
+        pending = self.pending.setdefault(name, [0, None])
+        pending[0] += delta
+        if items is not None:
+            if pending[1] is None:
+                pending[1] = ItemInventory()
+            pending[1].add(items)
+
+    def add(self, name, delta, items=None):
+        """Journals the change then merges it into the pending list"""
+        self.journal.append({'name': name, 'delta': delta, 'items': items})
+        self._merge(name, delta, items)
+
+    def apply(self, name, splits, items):
+        """Adds name's pending change to values read from the sheet"""
+        if name not in self.pending:
+            return splits, items
+        delta, new_items = self.pending[name]
+        if new_items is not None:
+            items = str(ItemInventory(items).merge(new_items))
+        return splits + delta, items
+
+    def begin_flush(self, cells):
+        """Journals a flush's absolute cells before they are written"""
+        self.journal.append({
+            'flush': [[row, col, value] for (row, col), value in cells.items()]
+        })
+
+    def clear(self):
+        """Empties the pending list and the journal after a flush"""
+        self.pending = {}
+        self.flushing = {}
+        self.journal.truncate()
+
+    def close(self):
+        self.journal.close()